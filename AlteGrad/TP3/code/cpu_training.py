@@ -0,0 +1,80 @@
+import time
+import inspect
+import numpy as np
+
+import tensorflow as tf
+from keras import backend as K
+from keras.callbacks import Callback
+
+# = = = = = CPU training profile = = = = =
+# configure_threads and set_bfloat16_policy must be called before the model is built
+
+def configure_threads(intra_op_threads=0,inter_op_threads=0):
+    '''sets the nb of threads used within an op (e.g., one matrix product) and across independent ops
+    0 lets TensorFlow pick (nb of physical cores). Works with both TF 2 and TF 1 (session config)'''
+    if hasattr(tf,'config') and hasattr(tf.config,'threading'):
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    else:
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        K.set_session(tf.Session(config=config))
+
+
+def set_bfloat16_policy():
+    '''layers built afterwards compute in bfloat16 and keep float32 weights
+    the output layer should be given dtype='float32' so that the loss is computed in float32
+    returns False (and keeps float32) if the installed Keras has no mixed precision support'''
+    try:
+        from keras import mixed_precision
+    except ImportError:
+        # the tf.keras policy is only read by the keras layers if keras is tf.keras (not multi-backend Keras <= 2.3)
+        import keras.layers
+        try:
+            import tensorflow.keras.layers
+            from tensorflow.keras import mixed_precision
+        except ImportError:
+            mixed_precision = None
+        if mixed_precision is None or keras.layers.Dense is not tensorflow.keras.layers.Dense:
+            print('mixed precision not supported by this Keras version, training in float32')
+            return False
+    if hasattr(mixed_precision,'set_global_policy'):
+        mixed_precision.set_global_policy('mixed_bfloat16')
+    else:
+        mixed_precision.experimental.set_policy('mixed_bfloat16')
+    return True
+
+
+def scaled_learning_rate(base_lr,batch_size,base_batch_size=64,rule='linear'):
+    '''learning rate for 'batch_size', given the learning rate 'base_lr' tuned for 'base_batch_size'
+    'linear': lr grows like the batch size (Goyal et al. 2017), 'sqrt': like its square root (more conservative, often better with Adam)'''
+    ratio = batch_size/float(base_batch_size)
+    if rule == 'linear':
+        return base_lr*ratio
+    elif rule == 'sqrt':
+        return base_lr*np.sqrt(ratio)
+    raise ValueError('unknown learning rate scaling rule: ' + str(rule))
+
+
+def adam(learning_rate):
+    '''Adam optimizer with the given learning rate, whatever the Keras version (the argument is 'lr' up to Keras 2.2)'''
+    from keras.optimizers import Adam
+    if 'learning_rate' in inspect.signature(Adam.__init__).parameters:
+        return Adam(learning_rate=learning_rate)
+    return Adam(lr=learning_rate)
+
+
+class EpochTimer(Callback):
+    '''reports the duration of each epoch and the training throughput in documents/sec'''
+    def __init__(self,n_docs):
+        super(EpochTimer, self).__init__()
+        self.n_docs = n_docs
+        self.epoch_times = []
+
+    def on_epoch_begin(self,epoch,logs=None):
+        self.t0 = time.time()
+
+    def on_epoch_end(self,epoch,logs=None):
+        duration = time.time() - self.t0
+        self.epoch_times.append(duration)
+        print('epoch',epoch+1,'took',round(duration,1),'sec,',round(self.n_docs/duration,1),'docs/sec')
@@ -0,0 +1,128 @@
+import os
+import numpy as np
+
+# = = = = = parsing and caching = = = = =
+
+def parse_chunk(lines,max_size,padding_idx):
+    '''parses a list of comma-separated lines into a (len(lines),max_size) int32 array
+    all the integers of the chunk are converted in a single call, truncation and padding are done with fancy indexing'''
+    lines = [line.strip() for line in lines]
+    lengths = np.array([line.count(',')+1 if line else 0 for line in lines],dtype=np.int64)
+    flat = np.array(','.join([line for line in lines if line]).split(','),dtype=np.int32) if lengths.sum() else np.zeros(0,dtype=np.int32)
+    offsets = np.concatenate(([0],np.cumsum(lengths)[:-1]))
+
+    positions = np.arange(max_size)
+    valid = positions[None,:] < lengths[:,None] # (chunk,max_size), True where a real token will be written
+
+    padded = np.full((len(lines),max_size),padding_idx,dtype=np.int32)
+    padded[valid] = flat[(offsets[:,None]+positions[None,:])[valid]]
+    return padded, np.minimum(lengths,max_size).astype(np.int32)
+
+
+def load_padded(csv_path,max_size,padding_idx,chunk_size=10000,cache_dir=None):
+    '''reads a csv of word indexes into a padded (n_docs,max_size) int32 array, plus the (truncated) lengths
+    the result is cached as .npy next to the csv (or in 'cache_dir') and reloaded on subsequent calls'''
+    if cache_dir is None:
+        cache_dir = os.path.dirname(csv_path)
+    name = os.path.splitext(os.path.basename(csv_path))[0] + '_' + str(max_size)
+    x_path = os.path.join(cache_dir, name + '.npy')
+    len_path = os.path.join(cache_dir, name + '_lengths.npy')
+
+    if os.path.exists(x_path) and os.path.exists(len_path) and os.path.getmtime(x_path) >= os.path.getmtime(csv_path):
+        return np.load(x_path), np.load(len_path)
+
+    x_chunks = []
+    len_chunks = []
+    with open(csv_path, 'r') as my_file:
+        while True:
+            lines = my_file.readlines(chunk_size*max_size*6) # size hint in characters, ~6 characters per index
+            if not lines:
+                break
+            padded, lengths = parse_chunk(lines,max_size,padding_idx)
+            x_chunks.append(padded)
+            len_chunks.append(lengths)
+
+    x = np.concatenate(x_chunks) if x_chunks else np.zeros((0,max_size),dtype=np.int32)
+    lengths = np.concatenate(len_chunks) if len_chunks else np.zeros(0,dtype=np.int32)
+
+    np.save(x_path,x)
+    np.save(len_path,lengths)
+    return x, lengths
+
+
+def load_labels(txt_path):
+    return np.loadtxt(txt_path,dtype=np.int32,ndmin=1)
+
+# = = = = = feeding Keras = = = = =
+
+def make_batches(lengths,batch_size,bucketing=True,shuffle=True,seed=None):
+    '''returns a list of arrays of document indexes
+    with bucketing, documents are sorted by length (with random tie breaking) before being cut into batches,
+    so that each batch contains documents of similar length. The order of the batches is then shuffled'''
+    rng = np.random.RandomState(seed)
+    n_docs = len(lengths)
+    if bucketing:
+        tie_breaker = rng.permutation(n_docs) if shuffle else np.arange(n_docs)
+        order = np.lexsort((tie_breaker,lengths))
+    else:
+        order = rng.permutation(n_docs) if shuffle else np.arange(n_docs)
+    batches = [order[i:i+batch_size] for i in range(0,n_docs,batch_size)]
+    if shuffle:
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+    return batches
+
+
+class BatchGenerator(object):
+    '''infinite generator of (x_batch,y_batch) to be passed to model.fit_generator
+    each batch is cut to the length of its longest document (but never below 'min_size', which should be
+    at least the largest filter size, otherwise the convolutions have no valid position)
+    batches are re-drawn at the beginning of each epoch'''
+    def __init__(self,x,y,lengths,batch_size,bucketing=True,shuffle=True,min_size=1,seed=None):
+        self.x = x
+        self.y = np.asarray(y)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucketing = bucketing
+        self.shuffle = shuffle
+        self.min_size = min_size
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return int(np.ceil(len(self.x)/float(self.batch_size))) # steps per epoch
+
+    def padding_ratio(self):
+        '''fraction of padding tokens in the batches of the current epoch'''
+        batches = make_batches(self.lengths,self.batch_size,self.bucketing,False)
+        n_real = float(self.lengths.sum())
+        n_total = sum([len(idxs)*max(self.lengths[idxs].max(),self.min_size) for idxs in batches])
+        return 1 - n_real/n_total
+
+    def __iter__(self):
+        while True:
+            seed = None if self.seed is None else self.seed + self.epoch
+            for idxs in make_batches(self.lengths,self.batch_size,self.bucketing,self.shuffle,seed):
+                size = max(self.lengths[idxs].max(),self.min_size)
+                yield self.x[idxs,:size], self.y[idxs]
+            self.epoch += 1
+
+
+def fit_streaming(model,generator,epochs,validation_data=None,callbacks=None,max_queue_size=10,workers=1):
+    '''trains a Keras model from a BatchGenerator
+    batches are prepared in a background thread and kept in a queue of 'max_queue_size' batches (prefetching)
+    'validation_data' can be a BatchGenerator as well (with shuffle=False), so that the model is evaluated on batches
+    cut to their longest document as during training, rather than on documents padded to 'max_size' (each epoch
+    evaluates exactly one pass over it)'''
+    validation_steps = None
+    if isinstance(validation_data,BatchGenerator):
+        validation_steps = len(validation_data)
+        validation_data = iter(validation_data)
+    return model.fit_generator(iter(generator),
+                               steps_per_epoch=len(generator),
+                               epochs=epochs,
+                               validation_data=validation_data,
+                               validation_steps=validation_steps,
+                               callbacks=callbacks,
+                               max_queue_size=max_queue_size,
+                               workers=workers,
+                               use_multiprocessing=False)
@@ -0,0 +1,46 @@
+import numpy as np
+
+from keras import backend as K
+
+# = = = = = inner representations of the model = = = = =
+
+def layer_function(model,layer_names):
+    '''K.function returning the outputs of the layers named 'layer_names' (resolved with model.get_layer,
+    so that the code does not depend on the position of the layers in model.layers)
+    takes as input [docs,learning_phase], use learning_phase=0 for inference (dropout disabled)'''
+    if isinstance(layer_names,str):
+        layer_names = [layer_names]
+    outputs = [model.get_layer(name).output for name in layer_names]
+    return K.function([model.input, K.learning_phase()],outputs)
+
+
+def iterate_batches(my_function,x,batch_size):
+    '''runs 'my_function' on consecutive slices of 'x', yields (start index, list of outputs)
+    only one batch of activations is in memory at a time'''
+    for start in range(0,len(x),batch_size):
+        yield start, my_function([np.asarray(x[start:start+batch_size]),0])
+
+
+def extract_embeddings(model,x,layer_name='doc_embedding',batch_size=512,out_path=None):
+    '''computes the output of layer 'layer_name' for all the documents in 'x', 'batch_size' documents at a time
+    if 'out_path' is given, the embeddings are written to a memory-mapped float32 .npy file
+    (which can later be reopened without the model with load_embeddings), otherwise they are returned in memory'''
+    my_function = layer_function(model,layer_name)
+    embs = None
+    for start, outputs in iterate_batches(my_function,x,batch_size):
+        batch_embs = outputs[0]
+        if embs is None:
+            shape = (len(x),) + batch_embs.shape[1:]
+            if out_path is None:
+                embs = np.empty(shape,dtype=np.float32)
+            else:
+                embs = np.lib.format.open_memmap(out_path,mode='w+',dtype=np.float32,shape=shape)
+        embs[start:start+len(batch_embs)] = batch_embs
+    if out_path is not None and embs is not None:
+        embs.flush()
+    return embs
+
+
+def load_embeddings(path):
+    '''reopens embeddings saved by extract_embeddings without loading them in memory'''
+    return np.load(path,mmap_mode='r')
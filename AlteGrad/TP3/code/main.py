@@ -1,4 +1,3 @@
-import csv
 import json
 import numpy as np
 
@@ -11,6 +10,13 @@ from keras.models import Model
 from keras import backend as K
 from keras.layers import Input, Embedding, Dropout, Conv1D, GlobalMaxPooling1D, Concatenate, Dense
 
+from data_pipeline import load_padded, load_labels, BatchGenerator, fit_streaming
+from embeddings import layer_function, extract_embeddings
+from saliency import saliency_to_file
+from regions import iter_top_regions, mine_phrases
+from serving import export_weights
+from cpu_training import configure_threads, set_bfloat16_policy, scaled_learning_rate, adam, EpochTimer
+
 # = = = = = functions = = = = =
 
 def visualize_doc_embeddings(my_doc_embs,my_colors,my_labels,my_name):
@@ -42,8 +48,9 @@ def visualize_doc_embeddings(my_doc_embs,my_colors,my_labels,my_name):
 # pooling layers: https://keras.io/layers/pooling/
 # layers can be combined by nesting them as: layer_b(parameters_b)(layer_a(parameters_a)(input))
 
-def cnn_branch(n_filters,k_size,d_rate,my_input):
-    return Dropout(d_rate)(GlobalMaxPooling1D()(Conv1D(n_filters,k_size)(my_input)))
+def cnn_branch(n_filters,k_size,d_rate,my_input,name=None):
+    # 'name' is given to the convolutional layer, so that its feature maps can be retrieved with model.get_layer(name)
+    return Dropout(d_rate)(GlobalMaxPooling1D()(Conv1D(n_filters,k_size,name=name)(my_input)))
 
 # = = = = = parameters = = = = =
 
@@ -60,6 +67,24 @@ drop_rate = 0.3 # amount of dropout regularization
 batch_size = 64
 nb_epochs = 1
 my_optimizer = 'adam'
+use_bucketing = True # group reviews of similar length in the same batches
+emb_batch_size = 512 # nb of documents passed at once to the model when extracting embeddings
+
+# CPU training profile (makes training on the full training set feasible without a GPU)
+cpu_mode = False
+intra_op_threads = 0 # threads used within an op, 0: let TensorFlow decide
+inter_op_threads = 0 # threads used across independent ops, 0: let TensorFlow decide
+use_bf16 = True # bfloat16 mixed precision (only pays off on CPUs with native bfloat16 support, e.g., AVX512-BF16/AMX)
+cpu_batch_size = 512
+base_lr = 0.001 # Adam default, tuned for 'batch_size'
+lr_rule = 'sqrt' # 'linear' or 'sqrt' scaling of the learning rate with the batch size
+
+if cpu_mode:
+    configure_threads(intra_op_threads,inter_op_threads)
+    if use_bf16:
+        use_bf16 = set_bfloat16_policy() # False if the installed Keras cannot train in bfloat16
+    my_optimizer = adam(scaled_learning_rate(base_lr,cpu_batch_size,batch_size,lr_rule))
+    batch_size = cpu_batch_size
 
 # = = = = = loading data = = = = =
 
@@ -70,26 +95,12 @@ with open('./data/word_to_index.json', 'r') as my_file:
 # invert mapping (for sanity checking, later)
 index_to_word = dict((v,k) for k,v in word_to_index.items())
 
-with open('./data/training.csv', 'r') as my_file:
-    reader = csv.reader(my_file, delimiter=',')
-    x_train = list(reader)
-
-with open('./data/test.csv', 'r') as my_file:
-    reader = csv.reader(my_file, delimiter=',')
-    x_test = list(reader)
-
-with open('./data/training_labels.txt', 'r') as my_file:
-    y_train = my_file.read().splitlines()
-
-with open('./data/test_labels.txt', 'r') as my_file:
-    y_test = my_file.read().splitlines()
+# the csv files are parsed (truncated and padded to 'max_size') once, then reloaded from the .npy cache
+x_train, len_train = load_padded('./data/training.csv',max_size,padding_idx)
+x_test, len_test = load_padded('./data/test.csv',max_size,padding_idx)
 
-# turn lists of strings into lists of integers
-x_train = [[int(elt) for elt in sublist] for sublist in x_train]
-x_test = [[int(elt) for elt in sublist] for sublist in x_test]  
-
-y_train = [int(elt) for elt in y_train]
-y_test = [int(elt) for elt in y_test]
+y_train = load_labels('./data/training_labels.txt')
+y_test = load_labels('./data/test_labels.txt')
 
 print('data loaded')
 
@@ -100,22 +111,15 @@ print('index of "movie":',word_to_index['movie']) # very frequent word
 print('index of "elephant":',word_to_index['elephant']) # less frequent word
     
 # reconstruct first review
-rev = x_train[0]
+rev = x_train[0,:len_train[0]].tolist()
 print (' '.join([index_to_word[elt] if elt in index_to_word else 'OOV' for elt in rev]))
 # compare it with the original review: https://www.imdb.com/review/rw2219371/?ref_=tt_urv
 
 # = = = = = truncation and padding = = = = =
 
-# truncate reviews longer than 'max_size'
-x_train = [rev[:max_size] for rev in x_train]
-x_test = [rev[:max_size] for rev in x_test]
-
-# pad reviews shorter than 'max_size' with the special padding token
-x_train = [rev+[padding_idx]*(max_size-len(rev)) if len(rev)<max_size else rev for rev in x_train]
-x_test = [rev+[padding_idx]*(max_size-len(rev)) if len(rev)<max_size else rev for rev in x_test]
-
+# truncation and padding are done in 'load_padded'
 # all reviews should now be of size 'max_size'
-assert max_size == list(set([len(rev) for rev in x_train]))[0] and max_size == list(set([len(rev) for rev in x_test]))[0]
+assert x_train.shape[1] == max_size and x_test.shape[1] == max_size
 
 print('truncation and padding done')
 
@@ -127,19 +131,19 @@ print('truncation and padding done')
 doc_ints = Input(shape=(None,))
 
 ### fill the gap (add an Embedding layer) https://keras.io/layers/embeddings/ ###
-doc_wv = Embedding(len(index_to_word)+mfw_idx,d,input_length=max_size)(doc_ints)
+doc_wv = Embedding(len(index_to_word)+mfw_idx,d,input_length=max_size,name='word_embedding')(doc_ints)
 
 doc_wv_dr = Dropout(drop_rate)(doc_wv)
 
 branch_outputs = []
 for idx in range(nb_branches):
     ### fill the gap (use the cnn_branch function) ###
-    branch_outputs.append(cnn_branch(nb_filters,filter_sizes[idx],drop_rate,doc_wv_dr))
+    branch_outputs.append(cnn_branch(nb_filters,filter_sizes[idx],drop_rate,doc_wv_dr,name='conv_'+str(idx)))
 
-concat = Concatenate()(branch_outputs) # branch output combination
+concat = Concatenate(name='doc_embedding')(branch_outputs) # branch output combination
 
 ### fill the gap (add a Dense layer) https://keras.io/layers/core/ ###
-preds = Dense(1,activation='sigmoid')(concat)
+preds = Dense(1,activation='sigmoid',name='prediction',dtype='float32')(concat) # float32 output, even with mixed precision
 
 model = Model(doc_ints,preds)
 
@@ -167,7 +171,8 @@ print('total number of model parameters:',model.count_params())
 ### the input and output of a given layer can be accessed via, e.g., model.layers[0].input and model.layers[0].output ###
 ### see: How can I obtain the output of an intermediate layer? here: https://keras.io/getting-started/faq/ ###
 
-get_doc_embedding = K.function([model.layers[0].input, K.learning_phase()],[model.layers[9].output])
+# layers are resolved by name (see the architecture above) rather than by index
+get_doc_embedding = layer_function(model,'doc_embedding')
 
 n_plot = 1000
 labels_plt = y_test[:n_plot]
@@ -179,21 +184,35 @@ visualize_doc_embeddings(doc_embs,['blue','red'],labels_plt,'before')
 # = = = = = training = = = = =
 
 ### note: if you don't have a GPU, you may use a subset of x_train and y_train to speed up training ###
+### or set cpu_mode = True above ###
+
+# batches are cut to the length of their longest review; with bucketing, reviews of similar length are batched together
+train_generator = BatchGenerator(x_train,y_train,len_train,batch_size,bucketing=use_bucketing,min_size=max(filter_sizes))
+print('padding ratio of training batches:',round(train_generator.padding_ratio(),3))
 
-model.fit(np.array(x_train),
-          y_train,
-          batch_size = batch_size,
-          epochs = nb_epochs,
-          validation_data = (np.array(x_test), y_test))
+# the test set is evaluated on batches cut the same way (in a fixed order), so that global max pooling never sees
+# padding positions that training did not produce
+test_generator = BatchGenerator(x_test,y_test,len_test,batch_size,bucketing=use_bucketing,shuffle=False,min_size=max(filter_sizes))
+
+fit_streaming(model,
+              train_generator,
+              epochs = nb_epochs,
+              validation_data = test_generator,
+              callbacks = [EpochTimer(len(x_train))])
+
+# frozen weights for the NumPy inference server (see serving.py)
+export_weights(model,'./cnn_weights.npz',filter_sizes,max_size,padding_idx)
 
 # = = = = = visualizing doc embeddings (after training) = = = = =
 
 ### fill the gaps ###
 ### perform the same steps as before training and observe the changes ###
-get_doc_embedding = K.function([model.layers[0].input, K.learning_phase()],[model.layers[9].output])
+# embeddings of the whole test set are computed by batches and saved to disk (memory-mapped),
+# so that they can be reused for clustering/visualization without re-running the CNN
+doc_embs_all = extract_embeddings(model,x_test,'doc_embedding',batch_size=emb_batch_size,out_path='./data/test_doc_embeddings.npy')
 n_plot = 1000
 labels_plt = y_test[:n_plot]
-doc_embs = get_doc_embedding([np.array(x_test[:n_plot]),0])[0]
+doc_embs = np.asarray(doc_embs_all[:n_plot])
 
 print('plotting embeddings of first',n_plot,'documents')
 visualize_doc_embeddings(doc_embs,['blue','red'],labels_plt,'after')
@@ -203,7 +222,7 @@ visualize_doc_embeddings(doc_embs,['blue','red'],labels_plt,'after')
 ### fill the gaps ###
 ### define a K.function 'get_region_embedding' that returns the feature maps of the first branch ###
 
-get_region_embedding = K.function([model.layers[0].input, K.learning_phase()],[model.layers[3].output])
+get_region_embedding = layer_function(model,'conv_0')
 
 my_review_text = 'Oh , god , this was such a disappointment ! Worst movie ever . Not worth the 15 bucks .'
 tokens = my_review_text.lower().split()
@@ -222,17 +241,25 @@ reg_emb = get_region_embedding([my_review,0])[0][0,:,:]
 ### fill the gap ###
 ### compute the norms of the region embeddings ###
 ### you may use np.linalg.norm() https://docs.scipy.org/doc/numpy/reference/generated/numpy.linalg.norm.html ###
-norms = np.array([np.linalg.norm(elt) for elt in reg_emb])
+norms = np.linalg.norm(reg_emb,axis=-1)
 
 print([list(zip(regions,norms))[idx] for idx in np.argsort(-norms).tolist()])
 
+# = = = = = predictive text regions for all branches = = = = =
+
+# regions of all the branches compete for the top_k of each document
+print(next(iter_top_regions(model,my_review,[len(tokens)],filter_sizes,index_to_word,top_k=5)))
+
+# most frequent top regions over the test set
+print(mine_phrases(model,x_test,len_test,filter_sizes,index_to_word,top_k=3,batch_size=emb_batch_size,n_phrases=30))
+
 # = = = = = saliency map = = = = =
 
 input_tensors = [model.input, K.learning_phase()]
 ### fill the gap (extract the rows of the embedding matrix from the model) ###
-saliency_input = model.layers[1].output 
+saliency_input = model.get_layer('word_embedding').output 
 ### fill the gap (get the probability distribution over classes from the model) ###
-saliency_output = model.layers[10].output
+saliency_output = model.get_layer('prediction').output
 
 gradients = model.optimizer.get_gradients(saliency_output,saliency_input)
 
@@ -253,3 +280,15 @@ fig.colorbar(heatmap)
 fig.set_size_inches(11,7)
 fig.savefig('saliency_map.pdf',bbox_inches='tight')
 fig.show()
+
+# = = = = = saliency maps for many reviews (auditing) = = = = =
+
+# one backward pass per batch, results streamed to disk as (review, token, score)
+n_saliency = 5000
+saliency_to_file(model,
+                 [x_test[idx,:len_test[idx]] for idx in range(min(n_saliency,len(x_test)))],
+                 index_to_word,
+                 './saliency_test.tsv',
+                 batch_size = 256,
+                 padding_idx = padding_idx,
+                 min_size = max(filter_sizes))
@@ -0,0 +1,66 @@
+import numpy as np
+from collections import Counter
+
+from embeddings import layer_function
+
+# = = = = = predictive text regions for all branches = = = = =
+
+def region_function(model,nb_branches):
+    '''K.function returning the feature maps of the convolutional layers of all the branches (named 'conv_<idx>')'''
+    return layer_function(model,['conv_'+str(idx) for idx in range(nb_branches)])
+
+
+def region_norms(feature_maps,lengths,k_size):
+    '''(batch,length-k_size+1,nb_filters) feature maps -> (batch,length-k_size+1) norms of the region embeddings
+    regions that extend over the padding are given a score of -inf (except the first one of documents shorter
+    than 'k_size', so that every document has at least one region)'''
+    norms = np.linalg.norm(feature_maps,axis=-1)
+    starts = np.arange(norms.shape[1])
+    norms[starts[None,:]+k_size > np.maximum(lengths,k_size)[:,None]] = -np.inf
+    return norms
+
+
+def top_k_regions(norms,top_k):
+    '''(batch,n_regions) scores -> (batch,top_k) indexes of the best regions, by decreasing score
+    np.argpartition selects the top_k in linear time, only these are then sorted'''
+    top_k = min(top_k,norms.shape[1])
+    idxs = np.argpartition(-norms,top_k-1,axis=1)[:,:top_k]
+    order = np.argsort(-np.take_along_axis(norms,idxs,axis=1),axis=1)
+    return np.take_along_axis(idxs,order,axis=1)
+
+
+def iter_top_regions(model,x,lengths,filter_sizes,index_to_word,top_k=5,batch_size=512):
+    '''yields, for each document of 'x', the list of its 'top_k' regions over all the branches,
+    as (region text, branch index, norm) tuples sorted by decreasing norm'''
+    nb_branches = len(filter_sizes)
+    my_function = region_function(model,nb_branches)
+    for start in range(0,len(x),batch_size):
+        x_batch = np.asarray(x[start:start+batch_size])
+        len_batch = np.asarray(lengths[start:start+batch_size])
+        feature_maps = my_function([x_batch,0])
+
+        # regions of all the branches are concatenated along the region axis, so that they compete for the top_k
+        norms = np.concatenate([region_norms(feature_maps[idx],len_batch,filter_sizes[idx]) for idx in range(nb_branches)],axis=1)
+        branch_of = np.concatenate([np.full(feature_maps[idx].shape[1],idx) for idx in range(nb_branches)])
+        start_of = np.concatenate([np.arange(feature_maps[idx].shape[1]) for idx in range(nb_branches)])
+        best = top_k_regions(norms,top_k)
+
+        for row in range(len(x_batch)):
+            regions = []
+            for col in best[row]:
+                if np.isinf(norms[row,col]):
+                    continue
+                branch, pos = branch_of[col], start_of[col]
+                end = min(pos+filter_sizes[branch],len_batch[row])
+                text = ' '.join([index_to_word[elt] if elt in index_to_word else 'OOV' for elt in x_batch[row,pos:end]])
+                regions.append((text,int(branch),float(norms[row,col])))
+            yield regions
+
+
+def mine_phrases(model,x,lengths,filter_sizes,index_to_word,top_k=5,batch_size=512,n_phrases=50):
+    '''counts how often each region is among the 'top_k' regions of a document over the whole corpus
+    returns the 'n_phrases' most frequent (region text, count) pairs'''
+    counts = Counter()
+    for regions in iter_top_regions(model,x,lengths,filter_sizes,index_to_word,top_k,batch_size):
+        counts.update([text for text,_,_ in regions])
+    return counts.most_common(n_phrases)
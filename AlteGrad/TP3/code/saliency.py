@@ -0,0 +1,61 @@
+import time
+import numpy as np
+
+from keras import backend as K
+
+# = = = = = batched saliency maps = = = = =
+
+def saliency_function(model,input_layer='word_embedding',output_layer='prediction'):
+    '''K.function returning the gradient of the prediction with respect to the word embeddings, for a whole batch
+    the documents of a batch do not interact, so the gradient of the sum of the predictions with respect to
+    the embeddings of a document is the gradient of its own prediction: one backward pass gives all the saliency maps'''
+    saliency_input = model.get_layer(input_layer).output
+    saliency_output = model.get_layer(output_layer).output
+    gradients = K.gradients(K.sum(saliency_output),saliency_input)
+    return K.function([model.input, K.learning_phase()],gradients)
+
+
+def pad_reviews(reviews,padding_idx=0,min_size=1):
+    '''pads a list of reviews (lists of word indexes) to the length of the longest one (at least 'min_size')
+    returns the (batch,length) int32 array and the lengths of the reviews'''
+    lengths = np.array([len(rev) for rev in reviews],dtype=np.int32)
+    x = np.full((len(reviews),max(lengths.max(),min_size)),padding_idx,dtype=np.int32)
+    mask = np.arange(x.shape[1])[None,:] < lengths[:,None]
+    x[mask] = np.concatenate([np.asarray(rev,dtype=np.int32) for rev in reviews])
+    return x, lengths
+
+
+def compute_saliency(my_function,x,lengths):
+    '''returns the (batch,length) magnitudes (L2 norm over the embedding dimension) of the partial derivatives
+    of the prediction with respect to each token. Scores of padding positions are set to zero'''
+    gradients = my_function([x,0])[0] # (batch,length,d)
+    scores = np.linalg.norm(gradients,axis=-1)
+    scores[np.arange(x.shape[1])[None,:] >= lengths[:,None]] = 0
+    return scores
+
+
+def saliency_to_file(model,reviews,index_to_word,out_path,batch_size=256,padding_idx=0,min_size=1,verbose=True):
+    '''computes the saliency maps of all 'reviews' by batches of 'batch_size' and streams them to 'out_path'
+    one line per token: review index, token, score (tab-separated)
+    reviews are sorted by length before batching to limit padding. Returns the throughput in reviews/sec'''
+    my_function = saliency_function(model)
+    order = np.argsort([len(rev) for rev in reviews],kind='stable')
+
+    t0 = time.time()
+    with open(out_path,'w',encoding='utf-8') as my_file:
+        my_file.write('review\ttoken\tscore\n')
+        for start in range(0,len(order),batch_size):
+            idxs = order[start:start+batch_size]
+            x, lengths = pad_reviews([reviews[idx] for idx in idxs],padding_idx,min_size)
+            scores = compute_saliency(my_function,x,lengths)
+            lines = []
+            for row, idx in enumerate(idxs):
+                for pos in range(lengths[row]):
+                    token = index_to_word[x[row,pos]] if x[row,pos] in index_to_word else 'OOV'
+                    lines.append('%i\t%s\t%.6g\n' % (idx,token,scores[row,pos]))
+            my_file.writelines(lines)
+    throughput = len(reviews)/max(time.time()-t0,1e-9)
+
+    if verbose:
+        print('saliency computed for',len(reviews),'reviews:',round(throughput,1),'reviews/sec')
+    return throughput
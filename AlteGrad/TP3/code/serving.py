@@ -0,0 +1,217 @@
+import sys
+import time
+import queue
+import threading
+import numpy as np
+
+from concurrent.futures import Future
+
+# = = = = = frozen NumPy model = = = = =
+# pure NumPy forward pass of the TP3 architecture (inference only, dropout is the identity):
+# Embedding -> nb_branches x (Conv1D -> GlobalMaxPooling1D) -> Concatenate -> Dense(sigmoid)
+
+def export_weights(model,path,filter_sizes,max_size,padding_idx=0):
+    '''saves the weights of the trained Keras model (layers resolved by name) into a single .npz file
+    which can be served without Keras/TensorFlow'''
+    to_save = {'embedding':model.get_layer('word_embedding').get_weights()[0],
+               'filter_sizes':np.array(filter_sizes),
+               'max_size':np.array(max_size),
+               'padding_idx':np.array(padding_idx)}
+    for idx in range(len(filter_sizes)):
+        kernel, bias = model.get_layer('conv_'+str(idx)).get_weights()
+        to_save['conv_'+str(idx)+'_kernel'] = kernel # (k_size,d,nb_filters)
+        to_save['conv_'+str(idx)+'_bias'] = bias
+    dense_w, dense_b = model.get_layer('prediction').get_weights()
+    to_save['dense_w'] = dense_w
+    to_save['dense_b'] = dense_b
+    np.savez(path,**to_save)
+
+
+class NumpyCNN(object):
+    '''frozen TP3 CNN, takes (batch,length) arrays of word indexes and returns (batch,) probabilities'''
+    def __init__(self,weights):
+        self.embedding = weights['embedding'].astype(np.float32)
+        self.filter_sizes = [int(elt) for elt in weights['filter_sizes']]
+        self.max_size = int(weights['max_size'])
+        self.padding_idx = int(weights['padding_idx'])
+        self.kernels = [weights['conv_'+str(idx)+'_kernel'].astype(np.float32) for idx in range(len(self.filter_sizes))]
+        self.biases = [weights['conv_'+str(idx)+'_bias'].astype(np.float32) for idx in range(len(self.filter_sizes))]
+        self.dense_w = weights['dense_w'].astype(np.float32)
+        self.dense_b = weights['dense_b'].astype(np.float32)
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as weights:
+            return cls(dict(weights))
+
+    def pad(self,reviews):
+        '''truncates a list of reviews to 'max_size' and pads them to the longest one (but never below the largest
+        filter size), as the training batches (see data_pipeline.BatchGenerator)'''
+        reviews = [rev[:self.max_size] for rev in reviews]
+        size = max([len(rev) for rev in reviews]+[max(self.filter_sizes)])
+        x = np.full((len(reviews),size),self.padding_idx,dtype=np.int64)
+        for row, rev in enumerate(reviews):
+            x[row,:len(rev)] = rev
+        return x
+
+    def predict(self,x):
+        batch, length = x.shape
+        emb = self.embedding[x.ravel()] # (batch*length,d)
+        pooled = []
+        for kernel, bias in zip(self.kernels,self.biases):
+            k_size, d, nb_filters = kernel.shape
+            n_regions = length - k_size + 1
+            # a Conv1D is a sum over the k_size offsets of shifted (d -> nb_filters) projections:
+            # all the offsets are projected with a single (batch*length,d) x (d,k_size*nb_filters) product
+            proj = np.dot(emb,kernel.transpose(1,0,2).reshape(d,k_size*nb_filters)).reshape(batch,length,k_size,nb_filters)
+            fmap = proj[:,:n_regions,0,:].copy()
+            for offset in range(1,k_size):
+                fmap += proj[:,offset:offset+n_regions,offset,:]
+            pooled.append(fmap.max(axis=1) + bias) # the bias does not change the argmax over positions
+        logits = np.dot(np.concatenate(pooled,axis=1),self.dense_w) + self.dense_b
+        return 1/(1+np.exp(-logits[:,0]))
+
+# = = = = = dynamic batching server = = = = =
+
+class BatchingServer(object):
+    '''coalesces concurrent requests into batches for the model
+    a batch is sent to the model as soon as it contains 'max_batch_size' reviews, or when the oldest review
+    of the batch has waited 'max_latency' seconds'''
+    def __init__(self,cnn,max_batch_size=64,max_latency=0.005):
+        self.cnn = cnn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.requests = queue.Queue()
+        self.batch_sizes = []
+        self.worker = threading.Thread(target=self.serve)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self,review):
+        '''review: list of word indexes. Returns a Future whose result is the probability of the positive class'''
+        future = Future()
+        self.requests.put((review,future))
+        return future
+
+    def predict(self,review):
+        return self.submit(review).result()
+
+    def close(self):
+        self.requests.put(None)
+        self.worker.join()
+
+    def serve(self):
+        while True:
+            first = self.requests.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = time.time() + self.max_latency
+            stop = False
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self.batch_sizes.append(len(batch))
+            try:
+                probas = self.cnn.predict(self.cnn.pad([review for review,_ in batch]))
+                for (_,future), proba in zip(batch,probas):
+                    future.set_result(float(proba))
+            except Exception as e:
+                for _,future in batch:
+                    future.set_exception(e)
+            if stop:
+                return
+
+# = = = = = load testing = = = = =
+
+def throughput_vs_batch_size(cnn,reviews,batch_sizes):
+    '''raw model throughput (reviews/sec) for each batch size, without the server'''
+    results = {}
+    for batch_size in batch_sizes:
+        x = cnn.pad(reviews[:batch_size])
+        cnn.predict(x) # warm up
+        n_runs = max(1,2000//batch_size)
+        t0 = time.time()
+        for _ in range(n_runs):
+            cnn.predict(x)
+        results[batch_size] = n_runs*batch_size/(time.time()-t0)
+    return results
+
+
+def load_test(cnn,reviews,n_clients,max_batch_size,max_latency,requests_per_client=200):
+    '''n_clients threads send requests one at a time (each waits for its answer before sending the next one)
+    returns the throughput (reviews/sec), the mean batch size and the p50/p99 latencies (ms)'''
+    server = BatchingServer(cnn,max_batch_size,max_latency)
+    latencies = []
+    lock = threading.Lock()
+
+    def client(seed):
+        rng = np.random.RandomState(seed)
+        my_latencies = []
+        for _ in range(requests_per_client):
+            review = reviews[rng.randint(len(reviews))]
+            t0 = time.time()
+            server.predict(review)
+            my_latencies.append(time.time()-t0)
+        with lock:
+            latencies.extend(my_latencies)
+
+    clients = [threading.Thread(target=client,args=(seed,)) for seed in range(n_clients)]
+    t0 = time.time()
+    for elt in clients:
+        elt.start()
+    for elt in clients:
+        elt.join()
+    duration = time.time() - t0
+    server.close()
+
+    latencies = np.array(latencies)*1000
+    return {'throughput':len(latencies)/duration,
+            'mean_batch_size':float(np.mean(server.batch_sizes)),
+            'p50_ms':float(np.percentile(latencies,50)),
+            'p99_ms':float(np.percentile(latencies,99))}
+
+
+def random_weights(vocab_size,d=30,nb_filters=50,filter_sizes=[3,4],max_size=60,seed=0):
+    '''weights with the shapes of the TP3 model, to load test the server without a trained model'''
+    rng = np.random.RandomState(seed)
+    weights = {'embedding':rng.normal(0,0.05,(vocab_size,d)),
+               'filter_sizes':np.array(filter_sizes),
+               'max_size':np.array(max_size),
+               'padding_idx':np.array(0),
+               'dense_w':rng.normal(0,0.05,(nb_filters*len(filter_sizes),1)),
+               'dense_b':np.zeros(1)}
+    for idx, k_size in enumerate(filter_sizes):
+        weights['conv_'+str(idx)+'_kernel'] = rng.normal(0,0.05,(k_size,d,nb_filters))
+        weights['conv_'+str(idx)+'_bias'] = np.zeros(nb_filters)
+    return weights
+
+
+if __name__ == '__main__':
+    # usage: python serving.py [weights.npz]
+    # without argument, random weights with the shapes of the TP3 model are used
+    if len(sys.argv) > 1:
+        cnn = NumpyCNN.load(sys.argv[1])
+    else:
+        cnn = NumpyCNN(random_weights(vocab_size=50000))
+
+    rng = np.random.RandomState(0)
+    reviews = [rng.randint(2,cnn.embedding.shape[0],size=rng.randint(5,120)).tolist() for _ in range(2000)]
+
+    print('= = = model throughput vs batch size = = =')
+    for batch_size, throughput in throughput_vs_batch_size(cnn,reviews,[1,8,32,64,128,256]).items():
+        print('batch size',batch_size,':',round(throughput),'reviews/sec')
+
+    print('= = = server load test (32 concurrent clients) = = =')
+    for max_batch_size in [1,8,32,64]:
+        results = load_test(cnn,reviews,n_clients=32,max_batch_size=max_batch_size,max_latency=0.002)
+        print('max batch size',max_batch_size,':',{k:round(v,2) for k,v in results.items()})
@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import random
+import tempfile
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model import seq2seqModel
+from translation_cache import TranslationCache
+
+# = = = = = synthetic model and data = = = = =
+
+def synthetic_model(n_words_s=5000,n_words_t=5000,embedding_dim=40,hidden_dim=30,hidden_dim_att=20,max_size=30,seed=0):
+    '''untrained model with the sizes of the one trained in main.py, on synthetic vocabularies
+    (tokens 0 to 3 are <pad>, <oov>, <sos> and <eos>)'''
+    torch.manual_seed(seed)
+    vocab_s = {'s'+str(idx):idx for idx in range(4,n_words_s+4)}
+    vocab_t_inv = {idx:'t'+str(idx) for idx in range(4,n_words_t+4)}
+    return seq2seqModel(vocab_s=vocab_s,source_language='english',vocab_t_inv=vocab_t_inv,
+                        embedding_dim_s=embedding_dim,embedding_dim_t=embedding_dim,
+                        hidden_dim_s=hidden_dim,hidden_dim_t=hidden_dim,hidden_dim_att=hidden_dim_att,
+                        do_att=True,padding_token=0,oov_token=1,sos_token=2,eos_token=3,max_size=max_size)
+
+
+def synthetic_sources(model,n_sentences,min_len=3,max_len=20,seed=0):
+    '''list of random (seq) source LongTensors'''
+    rng = random.Random(seed)
+    return [torch.LongTensor([rng.randint(4,model.max_source_idx) for _ in range(rng.randint(min_len,max_len))]).to(model.device)
+            for _ in range(n_sentences)]
+
+
+def timeit(my_function,n_runs=3):
+    '''best wall-clock time (sec) over 'n_runs' calls'''
+    times = []
+    for _ in range(n_runs):
+        t0 = time.time()
+        my_function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.time()-t0)
+    return min(times)
+
+# = = = = = beam search = = = = =
+
+def beam_vs_greedy(model,sources,beam_size):
+    '''sentences/sec of the batched beam search (all beams of all sentences in one tensor)
+    versus calling greedy decoding once per beam for each sentence'''
+    model.eval()
+    batch_source = pad_sequence(sources,padding_value=model.padding_token)
+
+    def batched_beam():
+        model.beam_search(batch_source,beam_size,model.max_size)
+
+    def greedy_per_beam():
+        with torch.no_grad():
+            for source in sources:
+                for _ in range(beam_size):
+                    model.forward(source,model.max_size,True)
+
+    return {'batched_beam':len(sources)/timeit(batched_beam),
+            'greedy_per_beam':len(sources)/timeit(greedy_per_beam)}
+
+
+# = = = = = attention = = = = =
+
+def legacy_attention(att_mech,target_h,source_hs):
+    '''attention as computed before keys were precomputed: the decoder state is repeated over the source,
+    concatenated to it and the full concatenation is projected at every step'''
+    target_h_rep = target_h.repeat(source_hs.size(0),1,1)
+    concat_output = att_mech.ff_concat(torch.cat((target_h_rep,source_hs),-1))
+    scores = att_mech.ff_score(torch.tanh(concat_output)).squeeze(dim=2)
+    norm_scores = torch.softmax(scores,0)
+    weighted_source_hs = norm_scores*source_hs.permute((2,0,1))
+    return torch.sum(weighted_source_hs.permute((1,2,0)),0,keepdim=True)
+
+
+def attention_step_latency(model,batch_size,source_len,n_steps=200):
+    '''per decoder step latency (ms), legacy attention versus precomputed keys
+    for the attention alone ('att') and for the full step, attention + decoder ('step')'''
+    model.eval()
+    source = torch.randint(4,model.max_source_idx,(source_len,batch_size)).to(model.device)
+    target_input = torch.full((1,batch_size),model.sos_token,dtype=torch.long).to(model.device)
+    target_h = torch.zeros((1,batch_size,model.hidden_dim_t)).to(model.device)
+    results = {}
+    with torch.no_grad():
+        source_hs = model.encoder(source)
+        for with_decoder in [False,True]:
+
+            def legacy():
+                for _ in range(n_steps):
+                    source_context = legacy_attention(model.att_mech,target_h,source_hs)
+                    if with_decoder:
+                        model.decoder(target_input,source_context,target_h)
+
+            def precomputed():
+                source_keys = model.att_mech.precompute_keys(source_hs)
+                source_mask = source!=model.padding_token
+                for _ in range(n_steps):
+                    source_context = model.att_mech(target_h,source_hs,source_keys=source_keys,source_mask=source_mask)
+                    if with_decoder:
+                        model.decoder(target_input,source_context,target_h)
+
+            name = 'step' if with_decoder else 'att'
+            results['legacy_'+name+'_ms'] = 1000*timeit(legacy)/n_steps
+            results['precomputed_'+name+'_ms'] = 1000*timeit(precomputed)/n_steps
+    return results
+
+
+# = = = = = translation cache = = = = =
+
+def cache_latency(model,sentences,n_runs=5):
+    '''per sentence predict latency (ms) without cache, with a cold cache (tokenization cached only),
+    on memory hits and on hits of the sqlite tier (a new cache on the same file, as in another worker)'''
+    model.eval()
+    path_to_db = os.path.join(tempfile.mkdtemp(),'translations.db')
+    results = {}
+    with torch.no_grad():
+        model.translation_cache = None
+        model.token_cache = TranslationCache(max_size=100000)
+        results['no_cache_ms'] = 1000*timeit(lambda: [model.predict(elt) for elt in sentences],1)/len(sentences)
+        results['tokens_cached_ms'] = 1000*timeit(lambda: [model.predict(elt) for elt in sentences],1)/len(sentences)
+        model.translation_cache = TranslationCache(path_to_db=path_to_db)
+        [model.predict(elt) for elt in sentences] # fills both tiers
+        results['memory_hit_ms'] = 1000*timeit(lambda: [model.predict(elt) for elt in sentences],n_runs)/len(sentences)
+        def disk_hits():
+            model.translation_cache = TranslationCache(path_to_db=path_to_db)
+            [model.predict(elt) for elt in sentences]
+        results['disk_hit_ms'] = 1000*timeit(disk_hits,n_runs)/len(sentences)
+    model.translation_cache = None
+    return results
+
+
+if __name__ == '__main__':
+    # usage: python benchmarks.py [path_to_model.pt]
+    model = seq2seqModel.load(sys.argv[1]) if len(sys.argv) > 1 else synthetic_model()
+    sources = synthetic_sources(model,200)
+
+    print('= = = beam search (sentences/sec) = = =')
+    for beam_size in [2,5,10]:
+        results = beam_vs_greedy(model,sources,beam_size)
+        print('beam size',beam_size,':',{k:round(v,1) for k,v in results.items()})
+
+    print('= = = per step latency (ms) = = =')
+    for batch_size in [1,64,256]:
+        for source_len in [10,30,60]:
+            results = attention_step_latency(model,batch_size,source_len)
+            print('batch size',batch_size,'source length',source_len,':',{k:round(v,3) for k,v in results.items()})
+
+    print('= = = translation cache, per sentence latency (ms) = = =')
+    vocab_s_inv = {idx:word for word,idx in model.vocab_s.items()}
+    sentences = [' '.join(vocab_s_inv[idx] for idx in source.tolist()) for source in sources[:50]]
+    print({k:round(v,4) for k,v in cache_latency(model,sentences).items()})
@@ -0,0 +1,205 @@
+import os
+import copy
+import json
+import time
+import argparse
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+from model import seq2seqModel, seq2seqAtt
+from translation_cache import TranslationCache
+
+# = = = = = TorchScript modules = = = = =
+# inference-only (CPU, one sentence at a time, greedy decoding) versions of the modules of model.py,
+# written so that they can be scripted with TorchScript and dynamically quantized (nn.Linear/nn.GRU layers only)
+
+class ScriptEncoder(nn.Module):
+    '''Encoder without packing (a single sentence has no padding)'''
+    def __init__(self, encoder):
+        super(ScriptEncoder, self).__init__()
+        self.embedding = encoder.embedding
+        self.rnn = encoder.rnn
+
+    def forward(self, input):
+        hs, _ = self.rnn(self.embedding(input)) # (seq,1,feat)
+        return hs
+
+
+class ScriptAttention(nn.Module):
+    '''seq2seqAtt with ff_concat split into its source (keys) and target (query) halves, as two nn.Linear
+    (the weights of a quantized layer cannot be sliced as in seq2seqAtt.precompute_keys)'''
+    def __init__(self, att_mech):
+        super(ScriptAttention, self).__init__()
+        hidden_dim, in_dim = att_mech.ff_concat.weight.shape
+        hidden_dim_t = att_mech.hidden_dim_t
+        self.ff_keys = nn.Linear(in_dim-hidden_dim_t,hidden_dim)
+        self.ff_query = nn.Linear(hidden_dim_t,hidden_dim,bias=False)
+        with torch.no_grad():
+            self.ff_keys.weight.copy_(att_mech.ff_concat.weight[:,hidden_dim_t:])
+            self.ff_keys.bias.copy_(att_mech.ff_concat.bias)
+            self.ff_query.weight.copy_(att_mech.ff_concat.weight[:,:hidden_dim_t])
+        self.ff_score = att_mech.ff_score
+
+    def precompute_keys(self, source_hs):
+        return self.ff_keys(source_hs)
+
+    def forward(self, target_h, source_hs, source_keys):
+        scores = self.ff_score(torch.tanh(source_keys+self.ff_query(target_h))).squeeze(2) # (seq,1)
+        norm_scores = torch.softmax(scores,0)
+        return torch.sum(norm_scores.unsqueeze(2)*source_hs,0,keepdim=True) # (1,1,feat)
+
+
+class ScriptDecoderStep(nn.Module):
+    '''one timestep of the Decoder'''
+    def __init__(self, decoder):
+        super(ScriptDecoderStep, self).__init__()
+        self.embedding = decoder.embedding
+        self.rnn = decoder.rnn
+        self.ff_concat = decoder.ff_concat
+        self.predict = decoder.predict
+
+    def forward(self, input, source_context, h):
+        _, h = self.rnn(self.embedding(input), h)
+        tilde_h = torch.tanh(self.ff_concat(torch.cat((source_context,h),-1)))
+        return self.predict(tilde_h), h
+
+
+class ScriptTranslator(nn.Module):
+    '''greedy decoding of a (seq) source sentence, the decoding loop is scripted as well
+    returns the (<=max_size) target integers, <eos> included (same output as seq2seqModel.predict)'''
+    def __init__(self, model):
+        super(ScriptTranslator, self).__init__()
+        self.encoder = ScriptEncoder(model.encoder)
+        self.decoder = ScriptDecoderStep(model.decoder)
+        self.do_att = model.do_att
+        # a scripted module cannot have an optional submodule: without attention, an unused one is created
+        self.att_mech = ScriptAttention(model.att_mech if model.do_att else seq2seqAtt(1,model.hidden_dim_s,model.hidden_dim_t))
+        self.hidden_dim_t = model.hidden_dim_t
+        self.sos_token = model.sos_token
+        self.eos_token = model.eos_token
+        self.max_size = model.max_size
+
+    def forward(self, input):
+        source_hs = self.encoder(input.unsqueeze(1)) # (seq,1,feat)
+        source_keys = self.att_mech.precompute_keys(source_hs)
+        target_h = torch.zeros((1,1,self.hidden_dim_t))
+        target_input = torch.full((1,1),self.sos_token,dtype=torch.long)
+        outputs = []
+        for _ in range(self.max_size):
+            if self.do_att:
+                source_context = self.att_mech(target_h,source_hs,source_keys)
+            else:
+                source_context = source_hs[-1:]
+            prediction, target_h = self.decoder(target_input,source_context,target_h)
+            target_input = torch.argmax(prediction,-1) # (1,1)
+            outputs.append(target_input)
+            if int(target_input) == self.eos_token:
+                break
+        return torch.cat(outputs,0).view(-1)
+
+# = = = = = export = = = = =
+
+CONFIG = ['source_language','padding_token','oov_token','sos_token','eos_token','max_size']
+
+
+def export(model, path_to_file, quantize=True):
+    '''saves a self-contained TorchScript artifact (no need for model.py to load it): the scripted ScriptTranslator,
+    with its Linear/GRU layers dynamically quantized to int8 if 'quantize', and the vocabularies and special tokens
+    (as extra files of the archive)'''
+    model = copy.deepcopy(model).cpu().eval()
+    translator = ScriptTranslator(model).eval()
+    if quantize:
+        translator = torch.quantization.quantize_dynamic(translator,{nn.Linear,nn.GRU},dtype=torch.qint8)
+    scripted = torch.jit.script(translator)
+    extra_files = {'vocab_s.json':json.dumps(model.vocab_s),
+                   'vocab_t_inv.json':json.dumps(model.vocab_t_inv),
+                   'config.json':json.dumps({attr:getattr(model,attr) for attr in CONFIG})}
+    torch.jit.save(scripted,path_to_file,_extra_files=extra_files)
+
+
+class ExportedModel(object):
+    '''loads an artifact saved by export, same predict as seq2seqModel (greedy decoding)'''
+    sourceNl_to_ints = seq2seqModel.sourceNl_to_ints
+    targetInts_to_nl = seq2seqModel.targetInts_to_nl
+
+    def __init__(self, path_to_file):
+        extra_files = {'vocab_s.json':'','vocab_t_inv.json':'','config.json':''}
+        self.translator = torch.jit.load(path_to_file,map_location='cpu',_extra_files=extra_files)
+        self.vocab_s = json.loads(extra_files['vocab_s.json'])
+        self.vocab_t_inv = {int(k):v for k,v in json.loads(extra_files['vocab_t_inv.json']).items()} # json keys are strings
+        for attr, value in json.loads(extra_files['config.json']).items():
+            setattr(self,attr,value)
+        self.device = torch.device('cpu')
+        self.token_cache = TranslationCache(max_size=100000) # used by sourceNl_to_ints
+
+    def predict(self, source_nl):
+        with torch.no_grad():
+            target_ints = self.translator(self.sourceNl_to_ints(source_nl))
+        return ' '.join(self.targetInts_to_nl(target_ints.tolist()))
+
+# = = = = = benchmark = = = = =
+
+# the to_test sentences of main.py
+TO_TEST = ['I am a student.',
+           'I have a red car.',
+           'I love playing video games.',
+           'This river is full of fish.',
+           'The fridge is full of food.',
+           'The cat fell asleep on the mat.',
+           'my brother likes pizza.',
+           'I did not mean to hurt you .',
+           'She is so mean .',
+           'Help me pick out a tie to go with this suit!',
+           "I can't help but smoking weed",
+           'The kids were playing hide and seek',
+           'The cat fell asleep in front of the fireplace']
+
+
+def latencies(predict, sentences, n_runs):
+    '''per sentence latencies (ms) of 'predict' over 'n_runs' passes on the sentences (after one warm-up pass)'''
+    for elt in sentences:
+        predict(elt)
+    times = []
+    for _ in range(n_runs):
+        for elt in sentences:
+            t0 = time.time()
+            predict(elt)
+            times.append(1000*(time.time()-t0))
+    return np.array(times)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='exports a TP4 model (TorchScript, dynamic quantization) and compares '
+                                                 'the latency of the eager, scripted and quantized models on CPU')
+    parser.add_argument('--model', default='../models/pretrained_moodle.pt',
+                        help='model saved by seq2seqModel.save (an untrained synthetic model is used if "synthetic")')
+    parser.add_argument('--out', default='../models/exported', help='prefix of the exported artifacts')
+    parser.add_argument('--n_runs', type=int, default=20)
+    parser.add_argument('--n_threads', type=int, default=1, help='torch intra-op threads (1: typical serving setting)')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.n_threads)
+    if args.model == 'synthetic':
+        from benchmarks import synthetic_model
+        model = synthetic_model()
+    else:
+        model = seq2seqModel.load(args.model)
+    model = model.cpu().eval()
+    model.device = torch.device('cpu')
+
+    for name, quantize in [('scripted',False),('quantized',True)]:
+        export(model,args.out+'_'+name+'.pt',quantize=quantize)
+        print('%-10s artifact: %.2f MB' % (name,os.path.getsize(args.out+'_'+name+'.pt')/1e6))
+
+    candidates = [('eager',model),
+                  ('scripted',ExportedModel(args.out+'_scripted.pt')),
+                  ('quantized',ExportedModel(args.out+'_quantized.pt'))]
+    reference = [model.predict(elt) for elt in TO_TEST]
+    with torch.no_grad():
+        for name, candidate in candidates:
+            times = latencies(candidate.predict,TO_TEST,args.n_runs)
+            same = sum(candidate.predict(elt)==ref for elt,ref in zip(TO_TEST,reference))
+            print('%-10s mean %.2f ms, p50 %.2f ms, p99 %.2f ms, %i/%i translations identical to eager' %
+                  (name,times.mean(),np.percentile(times,50),np.percentile(times,99),same,len(TO_TEST)))
@@ -3,7 +3,6 @@ import json
 import matplotlib.pyplot as plt
 
 import torch
-from torch.utils import data
 
 # = = = = = = = = = = =
 
@@ -14,33 +13,11 @@ sys.path.insert(0, path_to_model)
 
 from model import seq2seqModel
 from model_with_viz import seq2seqModelwithViz
+from pair_store import load_pair_store
 
 path_to_data = path_root + 'data/'
 path_to_save_models = path_root + 'models/'
 
-# = = = = = = = = = = =
-
-class Dataset(data.Dataset):
-  def __init__(self, pairs):
-        self.pairs = pairs
-
-  def __len__(self):
-        return len(self.pairs) # total nb of observations
-
-  def __getitem__(self, idx):
-        source, target = self.pairs[idx] # one observation
-        return torch.LongTensor(source), torch.LongTensor(target)
-
-
-def load_pairs(train_or_test):
-    with open(path_to_data + 'pairs_' + train_or_test + '_ints.txt', 'r', encoding='utf-8') as file:
-        pairs_tmp = file.read().splitlines()
-    pairs_tmp = [elt.split('\t') for elt in pairs_tmp]
-    pairs_tmp = [[[int(eltt) for eltt in elt[0].split()],[int(eltt) for eltt in \
-                  elt[1].split()]] for elt in pairs_tmp]
-    return pairs_tmp
-
-
 # = = = = = = = = = = =
 
 do_att = True # should always be set to True
@@ -49,9 +26,6 @@ is_viz = True
 
 if not is_prod:
         
-    pairs_train = load_pairs('train')
-    pairs_test = load_pairs('test')
-    
     with open(path_to_data + 'vocab_source.json','r') as file:
         vocab_source = json.load(file) # word -> index
     
@@ -62,8 +36,9 @@ if not is_prod:
     
     print('data loaded')
         
-    training_set = Dataset(pairs_train)
-    test_set = Dataset(pairs_test)
+    # memory-mapped pair stores, built from pairs_*_ints.txt on the first run (much faster than parsing the .txt files)
+    training_set = load_pair_store(path_to_data,'train')
+    test_set = load_pair_store(path_to_data,'test')
     
     print('data prepared')
     
@@ -84,7 +59,11 @@ if not is_prod:
                          eos_token=3,
                          max_size=30) # max size of generated sentence in prediction mode
     
-    model.fit(training_set,test_set,lr=0.001,batch_size=64,n_epochs=20,patience=2)
+    # batches are collated in-process (num_workers=0); on Linux with spare cores, e.g. num_workers=2 and
+    # persistent_workers=True overlap collation with training (see seq2seqModel.fit)
+    model.fit(training_set,test_set,lr=0.001,batch_size=64,n_epochs=20,patience=2,
+              num_workers=0,pin_memory=torch.cuda.is_available(),
+              teacher_forcing=True)
     model.save(path_to_save_models + 'my_model.pt')
 
 else:
@@ -114,9 +93,12 @@ else:
                'The cat fell asleep in front of the fireplace'
                ]
     
-    for elt in to_test:
+    if not is_viz:
+        translations = model.predict_many(to_test) # batched decoding
+    
+    for idx, elt in enumerate(to_test):
         if not is_viz:
-            print('= = = = = \n','%s -> %s' % (elt,model.predict(elt)))
+            print('= = = = = \n','%s -> %s' % (elt,translations[idx]))
         else:
             trans, scores, source_ints = model.predict(elt) # score: (trans_length, source_length,batch)
             
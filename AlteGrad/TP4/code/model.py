@@ -1,18 +1,29 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 from torch.utils import data
-from torch.nn.utils.rnn import pad_sequence
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 
+import os
+import time
+import uuid
+import hashlib
 from tqdm import tqdm
 
 from nltk import word_tokenize
 
+from sampler import BucketBatchSampler, pair_lengths
+from pair_store import PadCollate
+from translation_cache import TranslationCache, normalize
+
 
 class Encoder(nn.Module):
     '''
     to be passed the entire source sequence at once
     we use padding_idx in nn.Embedding so that the padding vector does not take gradient (always zero)
+    if the lengths of the sequences are given, the GRU is run on a packed sequence and does not process the padding
+    (the outputs at padded positions are zeros)
     https://pytorch.org/docs/stable/nn.html#gru
     '''
     def __init__(self, vocab_size, embedding_dim, hidden_dim, padding_idx):
@@ -20,11 +31,16 @@ class Encoder(nn.Module):
         self.embedding = nn.Embedding(vocab_size, embedding_dim, padding_idx)
         self.rnn = nn.GRU(embedding_dim, hidden_dim)
     
-    def forward(self, input):
+    def forward(self, input, lengths=None):
         # fill the gaps # (transform input into embeddings and pass embeddings to RNN)
         # you should return a tensor of shape (seq,batch,feat)
         embedded_s = self.embedding(input)
-        hs, _ = self.rnn(embedded_s)
+        if lengths is None:
+            hs, _ = self.rnn(embedded_s)
+        else:
+            packed = pack_padded_sequence(embedded_s,lengths.cpu(),enforce_sorted=False) # lengths must be on CPU
+            hs, _ = self.rnn(packed)
+            hs, _ = pad_packed_sequence(hs,total_length=input.size(0))
         return hs
 
 
@@ -32,28 +48,55 @@ class seq2seqAtt(nn.Module):
     '''
     concat global attention a la Luong et al. 2015 (subsection 3.1)
     https://arxiv.org/pdf/1508.04025.pdf
+    ff_concat is linear, so ff_concat([h_t;h_s]) = W_t h_t + (W_s h_s + b): the source half (the keys) does not
+    depend on the decoder state and is computed once per sentence with precompute_keys, then reused at every step
     '''
     def __init__(self, hidden_dim, hidden_dim_s, hidden_dim_t):
         super(seq2seqAtt, self).__init__()
+        self.hidden_dim_t = hidden_dim_t
         self.ff_concat = nn.Linear(hidden_dim_s+hidden_dim_t,hidden_dim)
         self.ff_score = nn.Linear(hidden_dim,1,bias=False) # just a dot product here
     
-    def forward(self,target_h,source_hs):
-        target_h_rep = target_h.repeat(source_hs.size(0),1,1) # (1,batch,feat) -> (seq,batch,feat)
-        # fill the gaps #
+    def precompute_keys(self,source_hs):
+        '''W_s h_s + b for all the source states, (seq,batch,feat) -> (seq,batch,hidden_dim)'''
+        return F.linear(source_hs,self.ff_concat.weight[:,self.hidden_dim_t:],self.ff_concat.bias)
+    
+    def forward(self,target_h,source_hs,return_scores=False,source_keys=None,source_mask=None):
+        '''source_keys: output of precompute_keys (computed here if not given)
+        source_mask: (seq,batch) boolean tensor, False for the padding positions of the source (which get a score of -inf)'''
+        if source_keys is None:
+            source_keys = self.precompute_keys(source_hs)
         # implement the score computation part of the concat formulation (see section 3.1. of Luong 2015)
-        concat_output = self.ff_concat(torch.cat((target_h_rep,source_hs),-1)) # (seq, batch, hidden_dim)
-        scores = self.ff_score(torch.tanh(concat_output))# should be of shape (seq,batch,1)
+        target_key = F.linear(target_h,self.ff_concat.weight[:,:self.hidden_dim_t]) # (1,batch,hidden_dim), broadcast over seq
+        scores = self.ff_score(torch.tanh(source_keys+target_key)) # should be of shape (seq,batch,1)
         scores = scores.squeeze(dim=2) # (seq,batch,1) -> (seq,batch). dim=2 because we don't want to squeeze the batch dim if batch size = 1
+        if source_mask is not None:
+            scores = scores.masked_fill(~source_mask,float('-inf'))
         norm_scores = torch.softmax(scores,0)
-        source_hs_p = source_hs.permute((2,0,1)) # (seq,batch,feat) -> (feat,seq,batch)
-        weighted_source_hs = (norm_scores * source_hs_p) # (seq,batch) * (feat,seq,batch) (* checks from right to left that the dimensions match)
-        ct = torch.sum(weighted_source_hs.permute((1,2,0)),0,keepdim=True) # (feat,seq,batch) -> (seq,batch,feat) -> (1,batch,feat); keepdim otherwise sum squeezes 
+        # weighted sum of the source states by broadcasting, without permuting the source states
+        # (on CPU this is ~8x faster than a (batch,1,seq) x (batch,seq,feat) torch.bmm, which runs batch tiny products)
+        ct = torch.sum(norm_scores.unsqueeze(2)*source_hs,0,keepdim=True) # (seq,batch,1) * (seq,batch,feat) -> (1,batch,feat)
+        if return_scores:
+            return ct, norm_scores # norm_scores: (seq,batch)
         return ct
+    
+    def attend_all(self,target_hs,source_hs,source_keys=None,source_mask=None):
+        '''attention for all the decoder steps at once (teacher forcing), target_hs: (seq_t,batch,feat)
+        returns the (seq_t,batch,feat) source contexts, same as calling forward on each target_hs[t:t+1]'''
+        if source_keys is None:
+            source_keys = self.precompute_keys(source_hs)
+        target_keys = F.linear(target_hs,self.ff_concat.weight[:,:self.hidden_dim_t]) # (seq_t,batch,hidden_dim)
+        scores = self.ff_score(torch.tanh(source_keys.unsqueeze(0)+target_keys.unsqueeze(1))).squeeze(dim=3) # (seq_t,seq_s,batch)
+        if source_mask is not None:
+            scores = scores.masked_fill(~source_mask.unsqueeze(0),float('-inf'))
+        norm_scores = torch.softmax(scores,1)
+        # one (batch) matrix product for all steps: (batch,seq_t,seq_s) x (batch,seq_s,feat)
+        return torch.bmm(norm_scores.permute(2,0,1),source_hs.transpose(0,1)).transpose(0,1) # (seq_t,batch,feat)
 
 
 class Decoder(nn.Module):
-    '''to be used one timestep at a time
+    '''to be used one timestep at a time (forward), or on the whole target sequence with teacher forcing
+       (the source context is not an input of the RNN, so rnn_states and output can be applied to all steps at once)
        see https://pytorch.org/docs/stable/nn.html#gru'''
     def __init__(self, vocab_size, embedding_dim, hidden_dim, padding_idx):
         super(Decoder, self).__init__()
@@ -66,13 +109,20 @@ class Decoder(nn.Module):
         # fill the gaps #
         # transform input into embeddings, pass embeddings to RNN, concatenate with source_context and apply tanh, and make the prediction
         # prediction should be of shape (1,batch,vocab), h and tilde_h of shape (1,batch,feat)
-        embedded_t = self.embedding(input)
-        _, h = self.rnn(embedded_t, h) #(1,batch,feat)
-        concat_output = self.ff_concat(torch.cat((source_context,h),-1)) #(1,batch,feat)
-        tilde_h = torch.tanh(concat_output) #(1,batch,feat)
-        prediction = self.predict(tilde_h) #(1,batch,vocab_size)
+        h = self.rnn_states(input, h)[-1:] #(1,batch,feat)
+        prediction = self.output(source_context, h) #(1,batch,vocab_size)
 
         return prediction, h
+    
+    def rnn_states(self, input, h):
+        '''(seq,batch) input tokens -> (seq,batch,feat) RNN states'''
+        hs, _ = self.rnn(self.embedding(input), h)
+        return hs
+    
+    def output(self, source_context, h):
+        '''(seq,batch,feat) source contexts and RNN states -> (seq,batch,vocab) predictions'''
+        tilde_h = torch.tanh(self.ff_concat(torch.cat((source_context,h),-1)))
+        return self.predict(tilde_h)
 
 
 class seq2seqModel(nn.Module):
@@ -114,16 +164,38 @@ class seq2seqModel(nn.Module):
         
         if self.do_att:
             self.att_mech = seq2seqAtt(self.hidden_dim_att,self.hidden_dim_s,self.hidden_dim_t).to(self.device)
+        
+        # source sentence -> source integers (word_tokenize is by far the slowest part of sourceNl_to_ints)
+        self.token_cache = TranslationCache(max_size=100000)
+        # normalized source sentence -> translation, used by predict and predict_many if set to a TranslationCache
+        # (e.g. TranslationCache(max_size=10000,ttl=3600,path_to_db='translations.db') to share it between workers)
+        self.translation_cache = None
+        # identifies the weights in the cache keys: models sharing a cache file only share the translations of the
+        # same weights (set from the checkpoint by load, changed by fit)
+        self.weights_version = uuid.uuid4().hex
     
     def my_pad(self,my_list):
         '''my_list is a list of tuples of the form [(tensor_s_1,tensor_t_1),...,(tensor_s_batch,tensor_t_batch)]
         the <eos> token is appended to each sequence before padding
+        the lengths of the source sequences (<eos> included) are returned as well, for the packed encoder
         https://pytorch.org/docs/stable/nn.html#torch.nn.utils.rnn.pad_sequence'''
-        batch_source = pad_sequence([torch.cat((elt[0],torch.LongTensor([self.eos_token]))) for elt in my_list],batch_first=True,padding_value=self.padding_token)
-        batch_target = pad_sequence([torch.cat((elt[1],torch.LongTensor([self.eos_token]))) for elt in my_list],batch_first=True,padding_value=self.padding_token)
-        return batch_source,batch_target
+        return PadCollate(self.eos_token,self.padding_token)(my_list)
+    
+    def encode(self,input,source_lengths=None):
+        '''runs the encoder on a (seq,batch) source batch (packed if 'source_lengths' is given)
+        returns the (seq,batch,feat) source states and the (1,batch,feat) last non-padding state of each sequence'''
+        source_hs = self.encoder(input,source_lengths)
+        if source_lengths is None:
+            last_hs = source_hs[-1,:,:].unsqueeze(0)
+        else:
+            last_hs = source_hs[source_lengths.to(source_hs.device)-1,torch.arange(input.size(1),device=source_hs.device)].unsqueeze(0)
+        return source_hs, last_hs
     
-    def forward(self,input,max_size,is_prod):
+    def forward(self,input,max_size,is_prod,source_lengths=None,return_att=False,sync_every=4):
+        '''return_att: the attention scores are returned as well, as a (steps,seq,batch) tensor on the device
+        (recorded in a preallocated tensor, no transfer to the host during decoding)
+        is_prod: decoding stops once all the sequences have emitted <eos>. The finished mask is kept on the device
+        and checked from the host every 'sync_every' steps only, so up to sync_every-1 steps may follow <eos>'''
         
         if is_prod: 
             input = input.unsqueeze(1) # (seq) -> (seq,1) 1D input <=> we receive just one sentence as input (predict/production mode)
@@ -132,7 +204,14 @@ class seq2seqModel(nn.Module):
     
         # fill the gap #
         # use the encoder
-        source_hs = self.encoder(input) #(seq,batch,feat)
+        source_hs, last_hs = self.encode(input,source_lengths) #(seq,batch,feat), (1,batch,feat)
+        
+        if self.do_att:
+            source_keys = self.att_mech.precompute_keys(source_hs) # once per sentence
+            source_mask = input!=self.padding_token # (seq,batch)
+        
+        if return_att:
+            att_scores = torch.zeros((max_size,input.size(0),current_batch_size),device=self.device)
         
         # = = = decoder part (one timestep at a time)  = = =
         
@@ -143,15 +222,19 @@ class seq2seqModel(nn.Module):
         # (initialize target_input with the proper token)
         target_input = torch.LongTensor([ self.sos_token ]).repeat(current_batch_size).unsqueeze(0).to(self.device) # init (1,batch)
         pos = 0
-        eos_counter = 0
+        if is_prod:
+            finished = torch.zeros(current_batch_size,dtype=torch.bool,device=self.device)
         logits = []
         
         while True:
             
             if self.do_att:
-                source_context = self.att_mech(target_h,source_hs) # (1,batch,feat)
+                source_context, norm_scores = self.att_mech(target_h,source_hs,return_scores=True,
+                                                             source_keys=source_keys,source_mask=source_mask) # (1,batch,feat), (seq,batch)
+                if return_att:
+                    att_scores[pos] = norm_scores.detach()
             else:
-                source_context = source_hs[-1,:,:].unsqueeze(0) # (1,batch,feat) last hidden state of encoder
+                source_context = last_hs # (1,batch,feat) last hidden state of encoder
             
             # fill the gap #
             # use the decoder
@@ -163,10 +246,12 @@ class seq2seqModel(nn.Module):
             # get the next input to pass the decoder
             target_input = torch.argmax(prediction,-1)
             
-            eos_counter += torch.sum(target_input==self.eos_token).item()
-            
             pos += 1
-            if pos>=max_size or (eos_counter == current_batch_size and is_prod):
+            if is_prod:
+                finished = finished | (target_input[0]==self.eos_token)
+                if pos % sync_every == 0 and bool(finished.all()):
+                    break
+            if pos>=max_size:
                 break
         
         to_return = torch.cat(logits,0) # logits is a list of tensors -> (seq,batch,vocab)
@@ -174,9 +259,45 @@ class seq2seqModel(nn.Module):
         if is_prod:
             to_return = to_return.squeeze(dim=1) # (seq,vocab)
         
+        if return_att:
+            return to_return, att_scores[:pos] # (steps,seq,batch), zeros without attention
         return to_return
     
-    def fit(self, trainingDataset, testDataset, lr, batch_size, n_epochs, patience):
+    def forward_teacher_forcing(self,input,target,source_lengths=None):
+        '''training with teacher forcing: the decoder is fed the ground truth (shifted) target instead of its own predictions
+        input and target: (seq,batch), returns the (seq_t,batch,vocab) logits
+        the decoder RNN runs on the whole target in one call, and attention is computed for all steps at once'''
+        current_batch_size = input.size(1)
+        source_hs, last_hs = self.encode(input,source_lengths) #(seq,batch,feat), (1,batch,feat)
+        
+        target_h = torch.zeros(size=(1,current_batch_size,self.hidden_dim_t)).to(self.device) # init (1,batch,feat)
+        sos = torch.full((1,current_batch_size),self.sos_token,dtype=torch.long,device=self.device)
+        target_input = torch.cat((sos,target[:-1]),0) # <sos> y_0 ... y_{T-2}
+        target_hs = self.decoder.rnn_states(target_input,target_h) # (seq_t,batch,feat), state after each input
+        
+        if self.do_att:
+            # as in forward, step t attends with the state before consuming its input: h_0 (zeros), ..., h_{T-1}
+            queries = torch.cat((target_h,target_hs[:-1]),0)
+            source_context = self.att_mech.attend_all(queries,source_hs,source_mask=input!=self.padding_token)
+        else:
+            source_context = last_hs.expand(target.size(0),-1,-1)
+        
+        return self.decoder.output(source_context,target_hs)
+    
+    def fit(self, trainingDataset, testDataset, lr, batch_size, n_epochs, patience, bucketing=False, max_tokens=None,
+            num_workers=0, pin_memory=False, persistent_workers=False, profile=False, teacher_forcing=False):
+        '''bucketing: batches of pairs of similar lengths (less padding), see sampler.BucketBatchSampler
+        max_tokens: with bucketing, batches are built by token budget (padded source+target tokens) instead of 'batch_size'
+        the weights version changes, so that the translations of the previous weights are no longer served by the
+        translation cache (if any), whose in-memory entries are dropped (the sqlite file may be shared with other models)
+        num_workers, pin_memory, persistent_workers: passed to the DataLoaders (batches are then collated in worker processes)
+        profile: prints, for each epoch, the time spent waiting for batches versus the time spent in the model
+        teacher_forcing: the training batches are decoded with forward_teacher_forcing (much faster), the test loss
+        is still computed by decoding the model's own predictions '''
+        
+        self.weights_version = uuid.uuid4().hex
+        if self.translation_cache is not None:
+            self.translation_cache.clear(disk=False)
         
         parameters = [p for p in self.parameters() if p.requires_grad]
         
@@ -187,14 +308,26 @@ class seq2seqModel(nn.Module):
         # https://pytorch.org/docs/stable/data.html#torch.utils.data.DataLoader
         # we pass a collate function to perform padding on the fly, within each batch
         # this is better than truncation/padding at the dataset level
-        train_loader = data.DataLoader(trainingDataset, batch_size=batch_size, 
-                                       shuffle=True, collate_fn=self.my_pad) # returns (batch,seq)
+        collate_fn = PadCollate(self.eos_token,self.padding_token) # same as self.my_pad, but picklable
+        loader_kwargs = {'collate_fn':collate_fn, 'num_workers':num_workers, 'pin_memory':pin_memory,
+                         'persistent_workers':persistent_workers and num_workers > 0}
+        non_blocking = pin_memory and self.device.type == 'cuda'
+        if bucketing:
+            source_lengths, target_lengths = pair_lengths(trainingDataset)
+            batch_sampler = BucketBatchSampler(source_lengths,target_lengths,batch_size,max_tokens)
+            random_ratio = BucketBatchSampler(source_lengths,target_lengths,batch_size,pool_size=1).padding_ratio()
+            print('padding ratio: %.3f with random batches, %.3f with bucketed batches' % (random_ratio,batch_sampler.padding_ratio()))
+            train_loader = data.DataLoader(trainingDataset, batch_sampler=batch_sampler,
+                                           **loader_kwargs) # returns (batch,seq)
+        else:
+            train_loader = data.DataLoader(trainingDataset, batch_size=batch_size, 
+                                           shuffle=True, **loader_kwargs) # returns (batch,seq)
         
         test_loader = data.DataLoader(testDataset, batch_size=64,
-                                      collate_fn=self.my_pad)
+                                      **loader_kwargs)
         
-        tdqm_dict_keys = ['loss', 'test loss']
-        tdqm_dict = dict(zip(tdqm_dict_keys,[0.0,0.0]))
+        tdqm_dict_keys = ['loss', 'test loss', 'tok/s']
+        tdqm_dict = dict(zip(tdqm_dict_keys,[0.0,0.0,0.0]))
         
         patience_counter = 1
         patience_loss = 99999
@@ -210,9 +343,16 @@ class seq2seqModel(nn.Module):
                         self.train()
                     else:
                         self.eval()
-                    for i, (batch_source,batch_target) in enumerate(loader):
-                        batch_source = batch_source.transpose(1,0).to(self.device) # RNN needs (seq,batch,feat) but loader returns (batch,seq)                        
-                        batch_target = batch_target.transpose(1,0).to(self.device) # (seq,batch)
+                    n_tokens = 0
+                    t0 = time.time()
+                    data_time = compute_time = 0
+                    t_fetch = time.time()
+                    for i, (batch_source,batch_target,source_lengths) in enumerate(loader):
+                        t_start = time.time()
+                        data_time += t_start - t_fetch
+                        n_tokens += int(source_lengths.sum()) + int((batch_target!=self.padding_token).sum()) # real (non padding) tokens, counted on CPU
+                        batch_source = batch_source.transpose(1,0).to(self.device,non_blocking=non_blocking) # RNN needs (seq,batch,feat) but loader returns (batch,seq)                        
+                        batch_target = batch_target.transpose(1,0).to(self.device,non_blocking=non_blocking) # (seq,batch)
                         
                         # are we using the model in production / as an API?
                         is_prod = len(batch_source.shape)==1 # if False, 2D input (seq,batch), i.e., train or test
@@ -223,7 +363,10 @@ class seq2seqModel(nn.Module):
                         else:
                             max_size = batch_target.size(0) # no need to continue generating after we've exceeded the length of the longest ground truth sequence
                         
-                        unnormalized_logits = self.forward(batch_source,max_size,is_prod)
+                        if teacher_forcing and loader_idx == 0:
+                            unnormalized_logits = self.forward_teacher_forcing(batch_source,batch_target,source_lengths)
+                        else:
+                            unnormalized_logits = self.forward(batch_source,max_size,is_prod,source_lengths)
 
                         sentence_loss = criterion(unnormalized_logits.flatten(end_dim=1),batch_target.flatten())
 
@@ -238,6 +381,16 @@ class seq2seqModel(nn.Module):
                             sentence_loss.backward() # compute gradients
                             optimizer.step() # update
                             pbar.update(1)
+                            tdqm_dict['tok/s'] = n_tokens/(time.time()-t0)
+                        
+                        if profile and self.device.type == 'cuda':
+                            torch.cuda.synchronize() # otherwise the asynchronous GPU work is counted as data loading
+                        t_fetch = time.time()
+                        compute_time += t_fetch - t_start
+                    
+                    if profile:
+                        pbar.write('%s: %.2fs data loading, %.2fs compute (%.1f%% data loading)' %
+                                   (['train','test'][loader_idx],data_time,compute_time,100*data_time/max(data_time+compute_time,1e-9)))
             
             if total_loss > patience_loss:
                 patience_counter += 1
@@ -249,11 +402,14 @@ class seq2seqModel(nn.Module):
                 break
     
     def sourceNl_to_ints(self,source_nl):
-        '''converts natural language source sentence into source integers'''
-        source_nl_clean = source_nl.lower().replace("'",' ').replace('-',' ')
-        source_nl_clean_tok = word_tokenize(source_nl_clean,self.source_language)
-        source_ints = [int(self.vocab_s[elt]) if elt in self.vocab_s else \
-                       self.oov_token for elt in source_nl_clean_tok]
+        '''converts natural language source sentence into source integers (memoized in self.token_cache)'''
+        source_ints = self.token_cache.get(source_nl)
+        if source_ints is None:
+            source_nl_clean = source_nl.lower().replace("'",' ').replace('-',' ')
+            source_nl_clean_tok = word_tokenize(source_nl_clean,self.source_language)
+            source_ints = [int(self.vocab_s[elt]) if elt in self.vocab_s else \
+                           self.oov_token for elt in source_nl_clean_tok]
+            self.token_cache.put(source_nl,source_ints)
         
         source_ints = torch.LongTensor(source_ints).to(self.device)
         return source_ints 
@@ -264,13 +420,179 @@ class seq2seqModel(nn.Module):
                 else '<EOS>' if elt==self.eos_token else '<SOS>' if elt==self.sos_token\
                 else self.vocab_t_inv[elt] for elt in target_ints]
     
-    def predict(self,source_nl):
+    def predict(self,source_nl,beam_size=1,return_att=False):
+        '''translation of a natural language sentence, looked up in / stored into self.translation_cache if set
+        if return_att, the (trans_length,source_length,1) attention scores and the source integers are returned as well,
+        as numpy arrays (the cache is not used)'''
+        if self.translation_cache is not None and not return_att:
+            key = self.cache_key(source_nl,beam_size)
+            translation = self.translation_cache.get(key)
+            if translation is None:
+                translation = self.translate(source_nl,beam_size)
+                self.translation_cache.put(key,translation)
+            return translation
+        return self.translate(source_nl,beam_size,return_att)
+    
+    def cache_key(self,source_nl,beam_size=1):
+        '''key of a translation in self.translation_cache: weights version, beam size and normalized sentence'''
+        return self.weights_version + '\t' + str(beam_size) + '\t' + normalize(source_nl)
+    
+    def translate(self,source_nl,beam_size=1,return_att=False):
         source_ints = self.sourceNl_to_ints(source_nl)
-        logits = self.forward(source_ints,self.max_size,True) # (seq) -> (<=max_size,vocab)
-        target_ints = logits.argmax(-1).squeeze() # (<=max_size,1) -> (<=max_size)
-        target_nl = self.targetInts_to_nl(target_ints.tolist())
+        if beam_size > 1:
+            target_ints, lengths, att_scores = self.beam_search(source_ints.unsqueeze(1),beam_size,self.max_size)
+            target_nl = self.targetInts_to_nl(target_ints[:lengths[0],0].tolist())
+            att_scores = att_scores[:lengths[0]]
+        else:
+            if return_att:
+                logits, att_scores = self.forward(source_ints,self.max_size,True,return_att=True)
+            else:
+                logits = self.forward(source_ints,self.max_size,True) # (seq) -> (<=max_size,vocab)
+            target_ints = logits.argmax(-1).view(-1).tolist() # (<=max_size,1) -> (<=max_size), view rather than squeeze to keep 1 token outputs 1D
+            if self.eos_token in target_ints: # forward only checks for <eos> every few steps: drop what follows it
+                target_ints = target_ints[:target_ints.index(self.eos_token)+1]
+                if return_att:
+                    att_scores = att_scores[:len(target_ints)]
+            target_nl = self.targetInts_to_nl(target_ints)
+        if return_att:
+            return ' '.join(target_nl), att_scores.cpu().numpy(), source_ints.cpu().numpy() # single transfer to the host
         return ' '.join(target_nl)
-        
+
+    def decode_greedy(self,input,max_size,sync_every=4,source_lengths=None):
+        '''batched greedy decoding (inference only)
+        input is a (seq,batch) padded source batch, 'source_lengths' the lengths of its sequences (packed encoder). A per-sequence finished mask is kept on the device,
+        and checked from the host only every 'sync_every' steps, so that there is no synchronization at each step
+        decoding stops as soon as all the sequences have emitted <eos>
+        returns the (steps,batch) target integers and the (batch) lengths of the outputs (<eos> included)'''
+        with torch.no_grad():
+            current_batch_size = input.size(1)
+            source_hs, last_hs = self.encode(input,source_lengths) #(seq,batch,feat)
+            if self.do_att:
+                source_keys = self.att_mech.precompute_keys(source_hs)
+                source_mask = input!=self.padding_token
+            target_h = torch.zeros(size=(1,current_batch_size,self.hidden_dim_t)).to(self.device)
+            target_input = torch.LongTensor([ self.sos_token ]).repeat(current_batch_size).unsqueeze(0).to(self.device) # (1,batch)
+            finished = torch.zeros(current_batch_size,dtype=torch.bool,device=self.device)
+            outputs = []
+
+            for pos in range(max_size):
+                if self.do_att:
+                    source_context = self.att_mech(target_h,source_hs,source_keys=source_keys,source_mask=source_mask) # (1,batch,feat)
+                else:
+                    source_context = last_hs
+                prediction, target_h = self.decoder(target_input,source_context,target_h)
+                target_input = torch.argmax(prediction,-1) # (1,batch)
+                outputs.append(target_input)
+                finished = finished | (target_input[0]==self.eos_token)
+                if (pos+1) % sync_every == 0 and bool(finished.all()):
+                    break
+
+            target_ints = torch.cat(outputs,0) # (steps,batch)
+            is_eos = target_ints==self.eos_token
+            # position of the first <eos> (argmax returns the first max), or the full length if there is none
+            lengths = torch.where(is_eos.any(0),is_eos.int().argmax(0)+1,torch.full_like(is_eos[0],target_ints.size(0),dtype=torch.long))
+        return target_ints, lengths
+
+    def beam_search(self,input,beam_size,max_size,len_alpha=0.6,source_lengths=None):
+        '''batched beam search decoding (inference only)
+        input is a (seq,batch) padded source batch. All the beams of all the sentences are decoded together,
+        as a single batch of size batch*beam_size: the encoder states are expanded once, and at each step
+        the hypotheses (decoder states, tokens, attention history) are reordered with index_select
+        finished hypotheses are frozen (they can only be extended by <pad> at no cost), and decoding stops
+        as soon as all the hypotheses are finished
+        final hypotheses are ranked by their log probability divided by the length penalty ((5+length)/6)**len_alpha (Wu et al. 2016)
+        returns the (steps,batch) target integers of the best hypotheses, their (batch) lengths (<eos> included),
+        and their (steps,seq,batch) attention scores (zeros without attention, the context is then the last encoder state)'''
+        with torch.no_grad():
+            batch_size = input.size(1)
+            vocab_size = self.max_target_idx+1
+            n_hyps = batch_size*beam_size
+
+            source_hs, last_hs = self.encode(input,source_lengths) # (seq,batch,feat), (1,batch,feat)
+            source_hs = source_hs.repeat_interleave(beam_size,dim=1) # (seq,batch*beam,feat), hypothesis b*beam_size+k belongs to sentence b
+            if self.do_att:
+                source_keys = self.att_mech.precompute_keys(source_hs)
+                source_mask = (input!=self.padding_token).repeat_interleave(beam_size,dim=1)
+            else:
+                source_context = last_hs.repeat_interleave(beam_size,dim=1) # (1,batch*beam,feat), the same at every step
+                norm_scores = torch.zeros((source_hs.size(0),n_hyps),device=self.device)
+
+            target_h = torch.zeros(size=(1,n_hyps,self.hidden_dim_t)).to(self.device)
+            target_input = torch.LongTensor([ self.sos_token ]).repeat(n_hyps).unsqueeze(0).to(self.device) # (1,batch*beam)
+
+            # at the first step, all the beams of a sentence are identical: only the first one is kept
+            beam_scores = torch.full((batch_size,beam_size),float('-inf'),device=self.device)
+            beam_scores[:,0] = 0
+            finished = torch.zeros((batch_size,beam_size),dtype=torch.bool,device=self.device)
+            lengths = torch.zeros((batch_size,beam_size),dtype=torch.long,device=self.device)
+            # log probabilities used to extend a finished hypothesis: <pad> at no cost, nothing else
+            finished_logp = torch.full((vocab_size,),float('-inf'),device=self.device)
+            finished_logp[self.padding_token] = 0
+            offsets = (torch.arange(batch_size,device=self.device)*beam_size).unsqueeze(1) # (batch,1)
+
+            hyps = torch.zeros((n_hyps,0),dtype=torch.long,device=self.device) # (batch*beam,steps)
+            att_hist = torch.zeros((0,source_hs.size(0),n_hyps),device=self.device) # (steps,seq,batch*beam)
+
+            for pos in range(max_size):
+                if self.do_att:
+                    source_context, norm_scores = self.att_mech(target_h,source_hs,return_scores=True,
+                                                                 source_keys=source_keys,source_mask=source_mask) # (1,batch*beam,feat), (seq,batch*beam)
+                prediction, target_h = self.decoder(target_input,source_context,target_h)
+                logp = torch.log_softmax(prediction[0],-1).view(batch_size,beam_size,vocab_size)
+                logp = torch.where(finished.unsqueeze(-1),finished_logp,logp)
+
+                candidates = (beam_scores.unsqueeze(-1)+logp).view(batch_size,-1) # (batch,beam*vocab)
+                beam_scores, best = candidates.topk(beam_size,dim=1) # (batch,beam)
+                origin = torch.div(best,vocab_size,rounding_mode='floor') # beam the new hypothesis comes from
+                tokens = best % vocab_size
+                flat_origin = (origin+offsets).view(-1) # (batch*beam)
+
+                target_h = target_h.index_select(1,flat_origin)
+                hyps = torch.cat((hyps.index_select(0,flat_origin),tokens.view(-1,1)),1)
+                att_hist = torch.cat((att_hist.index_select(2,flat_origin),norm_scores.index_select(1,flat_origin).unsqueeze(0)),0)
+
+                was_finished = finished.gather(1,origin)
+                lengths = lengths.gather(1,origin) + (~was_finished).long()
+                finished = was_finished | (tokens==self.eos_token)
+                target_input = tokens.view(1,-1)
+
+                if bool(finished.all()):
+                    break
+
+            length_penalty = ((5+lengths.float())/6)**len_alpha
+            best_beam = (beam_scores/length_penalty).argmax(1) # (batch)
+            best_hyp = best_beam + offsets.squeeze(1)
+
+            target_ints = hyps.index_select(0,best_hyp).t() # (steps,batch)
+            att_scores = att_hist.index_select(2,best_hyp) # (steps,seq,batch)
+            lengths = lengths.gather(1,best_beam.unsqueeze(1)).squeeze(1)
+        return target_ints, lengths, att_scores
+
+    def predict_many(self,sentences,batch_size=64):
+        '''translates a list of natural language sentences, 'batch_size' at a time
+        sentences are sorted by length so that each batch contains sentences of similar length (little padding)
+        the translations are returned in the original order, in the same format as predict
+        only the sentences missing from self.translation_cache (if set) are decoded'''
+        self.eval()
+        translations = [None]*len(sentences)
+        if self.translation_cache is not None:
+            keys = [self.cache_key(elt) for elt in sentences] # greedy decoding, same key as predict(beam_size=1)
+            translations = [self.translation_cache.get(key) for key in keys]
+        to_translate = [idx for idx in range(len(sentences)) if translations[idx] is None]
+        source_ints = {idx:self.sourceNl_to_ints(sentences[idx]) for idx in to_translate}
+        order = sorted(to_translate,key=lambda idx: len(source_ints[idx]))
+        for start in range(0,len(order),batch_size):
+            idxs = order[start:start+batch_size]
+            batch_source = pad_sequence([source_ints[idx] for idx in idxs],padding_value=self.padding_token) # (seq,batch)
+            source_lengths = torch.LongTensor([len(source_ints[idx]) for idx in idxs])
+            target_ints, lengths = self.decode_greedy(batch_source,self.max_size,source_lengths=source_lengths)
+            target_ints = target_ints.t().tolist() # single transfer to the host
+            for row, idx in enumerate(idxs):
+                translations[idx] = ' '.join(self.targetInts_to_nl(target_ints[row][:lengths[row]]))
+                if self.translation_cache is not None:
+                    self.translation_cache.put(keys[idx],translations[idx])
+        return translations
+
     def save(self,path_to_file):
         attrs = {attr:getattr(self,attr) for attr in self.ARGS}
         attrs['state_dict'] = self.state_dict()
@@ -282,4 +604,7 @@ class seq2seqModel(nn.Module):
         state_dict = attrs.pop('state_dict')
         new = cls(**attrs) # * list and ** names (dict) see args and kwargs
         new.load_state_dict(state_dict)
+        # same version for all the processes loading the same checkpoint, a new one if the file is overwritten
+        checkpoint = os.path.abspath(path_to_file) + '@' + repr(os.path.getmtime(path_to_file))
+        new.weights_version = hashlib.sha1(checkpoint.encode('utf-8')).hexdigest()[:16]
         return new        
@@ -0,0 +1,107 @@
+import os
+import time
+import sqlite3
+import threading
+
+from collections import OrderedDict
+
+
+def normalize(source_nl):
+    '''cache key of a source sentence: lowercased, with whitespace collapsed
+    (sourceNl_to_ints lowercases as well, so sentences with the same key have the same translation)'''
+    return ' '.join(source_nl.lower().split())
+
+
+class TranslationCache(object):
+    '''bounded LRU cache with an optional time to live, thread-safe
+    max_size: max number of entries kept in memory, the least recently used one is evicted beyond
+    ttl: entries older than 'ttl' seconds are treated as missing (None: no expiration)
+    path_to_db: optional persistent tier, an sqlite database shared by all the processes using the same file.
+    Entries missing from memory are looked up there, and every new entry is written to it (values must then be strings)'''
+    def __init__(self, max_size=10000, ttl=None, path_to_db=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path_to_db = path_to_db
+        self.entries = OrderedDict() # key -> (value, insertion time), from least to most recently used
+        self.lock = threading.Lock()
+        self.db = None
+        self.pid = None
+        self.reset_stats()
+
+    def __getstate__(self):
+        # locks and sqlite connections cannot be pickled/copied (DataLoader workers, copy.deepcopy of the model)
+        state = self.__dict__.copy()
+        del state['lock'], state['db']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.db = None
+
+    def reset_stats(self):
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def stats(self):
+        n_requests = self.hits + self.disk_hits + self.misses
+        return {'hits':self.hits, 'disk_hits':self.disk_hits, 'misses':self.misses,
+                'evictions':self.evictions, 'expirations':self.expirations, 'size':len(self.entries),
+                'hit_rate':(self.hits+self.disk_hits)/float(max(n_requests,1))}
+
+    def connect(self):
+        '''sqlite connection of the current process (a connection must not be shared with forked processes)'''
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path_to_db, timeout=30, check_same_thread=False, isolation_level=None)
+            self.db.execute('PRAGMA journal_mode=WAL') # readers do not block the writer (concurrent workers)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, time REAL)')
+            self.pid = os.getpid()
+        return self.db
+
+    def is_expired(self, insertion_time):
+        return self.ttl is not None and time.time()-insertion_time > self.ttl
+
+    def get(self, key):
+        '''value stored for 'key', or None'''
+        with self.lock:
+            if key in self.entries:
+                value, insertion_time = self.entries[key]
+                if not self.is_expired(insertion_time):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+                self.expirations += 1
+            if self.path_to_db is not None:
+                row = self.connect().execute('SELECT value, time FROM cache WHERE key=?',(key,)).fetchone()
+                if row is not None and not self.is_expired(row[1]):
+                    self.insert(key,row[0],row[1])
+                    self.disk_hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            insertion_time = time.time()
+            self.insert(key,value,insertion_time)
+            if self.path_to_db is not None:
+                self.connect().execute('INSERT OR REPLACE INTO cache VALUES (?,?,?)',(key,value,insertion_time))
+
+    def insert(self, key, value, insertion_time):
+        '''in memory only, the lock must be held'''
+        self.entries[key] = (value, insertion_time)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self, disk=True):
+        '''removes all the entries in memory, and on disk if 'disk' (for all the processes sharing the file)'''
+        with self.lock:
+            self.entries.clear()
+            if disk and self.path_to_db is not None:
+                self.connect().execute('DELETE FROM cache')
@@ -0,0 +1,313 @@
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.nn.init import xavier_uniform_
+
+from nltk.translate.bleu_score import corpus_bleu
+
+from transformer_moodle import Transformer, MultiHeadAttention, FusedMultiHeadAttention
+from bleu import corpus_bleu_ids
+
+# = = = = = synthetic model and data = = = = =
+
+def synthetic_transformer(fused_attention=False, n_words=5000, N_stacks=3, N_heads=8, dmodel=128,
+                          ff_inner_dim=512, max_size=24, device="cpu", seed=0,
+                          positional_encoding="sinusoidal"):
+    """ Untrained Transformer with the sizes of the one trained in
+    transformer_moodle.py, on synthetic vocabularies (tokens 0 to 3 are
+    <pad>, <oov>, <sos> and <eos>) """
+    torch.manual_seed(seed)
+    vocab_source = {'s'+str(idx): idx for idx in range(4, n_words+4)}
+    vocab_target_inv = {idx: 't'+str(idx) for idx in range(4, n_words+4)}
+    return Transformer(N_stacks_encoder=N_stacks, N_stacks_decoder=N_stacks,
+                       N_heads=N_heads, dk=dmodel//N_heads, dv=dmodel//N_heads, dmodel=dmodel,
+                       ff_inner_dim=ff_inner_dim, vocab_source=vocab_source,
+                       vocab_target_inv=vocab_target_inv, max_size=max_size,
+                       device=device, fused_attention=fused_attention,
+                       positional_encoding=positional_encoding)
+
+
+def attention_module(fused, N_heads, dmodel, device, chunk_size=None):
+    dk = dmodel//N_heads
+    if fused:
+        module = FusedMultiHeadAttention(N_heads, dk, dk, dmodel, device, chunk_size=chunk_size)
+    else:
+        module = MultiHeadAttention(N_heads, dk, dk, dmodel, device)
+    for p in module.parameters():
+        xavier_uniform_(p.data)
+    return module
+
+
+def causal_mask(T, device):
+    """ Additive forward mask (T, T), as Transformer.causal_mask """
+    return torch.full((T, T), float("-inf"), device=device).triu(1)
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timeit(my_function, device="cpu", n_runs=5):
+    """ Best wall-clock time (sec) over n_runs calls, after one warm-up call """
+    my_function()
+    times = []
+    for _ in range(n_runs):
+        synchronize(device)
+        t0 = time.time()
+        my_function()
+        synchronize(device)
+        times.append(time.time()-t0)
+    return min(times)
+
+# = = = = = attention = = = = =
+
+def reference_attention(module, Q, causal):
+    """ Per-head self-attention written head by head, to check the fused
+    module against """
+    H, dk, dv = module.N_heads, module.dk, module.dv
+    Wq, Wk, Wv = module.Wqkv.split([H*dk, H*dk, H*dv], -1)
+    heads = []
+    for h in range(H):
+        q = Q @ Wq[:, h*dk:(h+1)*dk]
+        k = Q @ Wk[:, h*dk:(h+1)*dk]
+        v = Q @ Wv[:, h*dv:(h+1)*dv]
+        scores = q @ k.transpose(-2, -1) / dk**0.5
+        if causal:
+            T = Q.size(1)
+            scores = scores.masked_fill(torch.ones(T, T, dtype=torch.bool, device=Q.device).triu(1), float("-inf"))
+        heads.append(F.softmax(scores, -1) @ v)
+    return torch.cat(heads, -1) @ module.Wo
+
+
+def check_fused(N_heads=8, dmodel=128, B=4, T=37, device="cpu"):
+    """ Max absolute difference of the fused module (scaled_dot_product_attention
+    and chunked softmax) to the head by head reference """
+    module = attention_module(True, N_heads, dmodel, device)
+    Q = torch.randn(B, T, dmodel, device=device)
+    results = {}
+    with torch.no_grad():
+        for causal in [False, True]:
+            reference = reference_attention(module, Q, causal)
+            mask = causal_mask(T, device) if causal else None
+            for chunk_size in [None, 8]:
+                module.chunk_size = chunk_size
+                name = ("causal_" if causal else "") + ("chunked" if chunk_size else "sdpa")
+                results[name] = (module(Q, Q, Q, mask)-reference).abs().max().item()
+    return results
+
+
+def attention_latency(B, T, N_heads=8, dmodel=128, device="cpu", backward=False):
+    """ Latency (ms) of the masked self-attention of the decoder: current
+    MultiHeadAttention, FusedMultiHeadAttention with
+    F.scaled_dot_product_attention, and with the chunked softmax. On cuda, the
+    peak memory (MB) is reported as well. """
+    candidates = [("current", attention_module(False, N_heads, dmodel, device)),
+                  ("fused_sdpa", attention_module(True, N_heads, dmodel, device)),
+                  ("fused_chunked", attention_module(True, N_heads, dmodel, device, chunk_size=16))]
+    x = torch.randn(B, T, dmodel, device=device, requires_grad=backward)
+    mask = causal_mask(T, device)
+    results = {}
+    for name, module in candidates:
+
+        def run():
+            if backward:
+                module(x, x, x, mask).sum().backward()
+            else:
+                with torch.no_grad():
+                    module(x, x, x, mask)
+
+        results[name+"_ms"] = 1000*timeit(run, device)
+        if torch.device(device).type == "cuda":
+            torch.cuda.reset_peak_memory_stats()
+            run()
+            results[name+"_MB"] = torch.cuda.max_memory_allocated()/2**20
+    return results
+
+# = = = = = positional encoding = = = = =
+
+def legacy_build_encoding(size, dimension):
+    """ Transformer.build_encoding as it was: one np.sin/np.cos call per pair
+    of columns, on torch tensors """
+    pos = torch.arange(size).view(-1,1)
+    dim = []
+    for _ in range(int(dimension/2)):
+        dim.append(np.sin(pos/(10000**(2*_/dimension))))
+        dim.append(np.cos(pos/(10000**((2*_+1)/dimension))))
+
+    return torch.cat(dim, 1)
+
+
+def positional_encoding_latency(B=64, size=24, dmodel=128, device="cpu", n_steps=1000):
+    """ Build time (ms) of the table, legacy loop versus vectorized, and per
+    call latency (us) of adding the positional encoding: Transformer.add_position
+    on the registered float32 buffer versus the previous
+    emb + PE_tensor[:T].float() """
+    model = synthetic_transformer(max_size=size, dmodel=dmodel, device=device)
+    emb = torch.randn(B, size, dmodel, device=device)
+    assert model.PE_tensor.dtype == torch.float and model.PE_tensor.device == emb.device
+
+    def add_position():
+        for _ in range(n_steps):
+            model.add_position(emb)
+
+    def legacy_add():
+        for _ in range(n_steps):
+            emb + model.PE_tensor[:emb.size()[1]].float()
+
+    return {"legacy_build_ms": 1000*timeit(lambda: legacy_build_encoding(size, dmodel), device),
+            "build_ms": 1000*timeit(lambda: model.build_encoding(size, dmodel), device),
+            "legacy_add_us": 1e6*timeit(legacy_add, device)/n_steps,
+            "add_position_us": 1e6*timeit(add_position, device)/n_steps}
+
+
+def decoding_latency(B, T, device="cpu"):
+    """ Greedy decoding latency (ms) of the Transformer for each positional
+    encoding """
+    results = {}
+    for positional_encoding in ["sinusoidal", "learned", "rotary"]:
+        model = synthetic_transformer(max_size=T, device=device,
+                                      positional_encoding=positional_encoding).eval()
+        x = torch.randint(4, 5004, (B, T-1), device=device)
+
+        def decode():
+            with torch.no_grad():
+                model(x)
+
+        results[positional_encoding+"_decode_ms"] = 1000*timeit(decode, device, 3)
+    return results
+
+# = = = = = evaluation = = = = =
+
+def synthetic_pairs(n_pairs, n_words=5000, max_len=22, seed=0):
+    """ Random (source, target) pairs of token ids """
+    rng = np.random.RandomState(seed)
+    return [[rng.randint(4, n_words+4, rng.randint(2, max_len)).tolist(),
+             rng.randint(4, n_words+4, rng.randint(2, max_len)).tolist()] for _ in range(n_pairs)]
+
+
+def legacy_evaluation(model, predictions, targets):
+    """ BLEU as Transformer.test computed it: EOS trimmed with a while loop
+    per sentence, ids converted to words, nltk corpus_bleu """
+    predictions, targets = predictions.tolist(), targets.tolist()
+    for sentences in [predictions, targets]:
+        for i, sentence in enumerate(sentences):
+            new = []
+            pos = 0
+            while pos < len(sentence) and sentence[pos] != model.EOS_token:
+                new.append(sentence[pos])
+                pos += 1
+            sentences[i] = new
+
+    return corpus_bleu([[model.targetInts_to_nl(_)] for _ in targets],
+                       [model.targetInts_to_nl(_) for _ in predictions])
+
+
+def evaluation_latency(model, pairs, n_jobs=1):
+    """ Time (sec) of the greedy decoding of the test pairs, and of the BLEU
+    evaluation of the decoded sentences, legacy versus on token ids (the
+    targets are used as predictions as well, so that BLEU is not 0) """
+    model.eval()
+    loader = model.sorted_loader(pairs, batch_size=64)
+    targets = torch.cat([F.pad(target, (0, model.max_size-1-target.size(1)))
+                         for _, target in loader])
+    predictions = torch.where(torch.rand(targets.size()) < 0.7, targets, torch.randint_like(targets, 4, 5004))
+
+    def decode():
+        with torch.no_grad():
+            for source, _ in loader:
+                model(source.to(model.device)).argmax(-1).cpu()
+
+    def ids_evaluation():
+        return corpus_bleu_ids(predictions.numpy(), model.eos_lengths(predictions).numpy(),
+                               targets.numpy(), model.eos_lengths(targets).numpy(), n_jobs=n_jobs)
+
+    assert abs(legacy_evaluation(model, predictions, targets) - ids_evaluation()) < 1e-9
+    return {"decode_s": timeit(decode, model.device, 1),
+            "legacy_evaluation_s": timeit(lambda: legacy_evaluation(model, predictions, targets), n_runs=1),
+            "ids_evaluation_s": timeit(ids_evaluation, n_runs=1)}
+
+# = = = = = full model = = = = =
+
+def model_latency(B, T, device="cpu"):
+    """ Training step (forward, backward) and greedy decoding latency (ms) of
+    the Transformer, current versus fused attention """
+    results = {}
+    for fused in [False, True]:
+        model = synthetic_transformer(fused, max_size=T, device=device)
+        # sentences of max_size-1 tokens (<eos> included), as padded by my_pad
+        x = torch.randint(4, 5004, (B, T-1), device=device)
+        y = torch.randint(4, 5004, (B, T-1), device=device)
+        optimizer = torch.optim.Adam(model.parameters())
+        name = "fused" if fused else "current"
+
+        def train_step():
+            optimizer.zero_grad()
+            logits = model(x, y)
+            F.cross_entropy(logits.reshape(-1, logits.size(-1)), y.reshape(-1)).backward()
+            optimizer.step()
+
+        def decode():
+            with torch.no_grad():
+                model(x)
+
+        results[name+"_train_ms"] = 1000*timeit(train_step, device, 3)
+        model.eval()
+        results[name+"_decode_ms"] = 1000*timeit(decode, device, 3)
+    return results
+
+
+def training_throughput(pairs, device="cpu", modes=None):
+    """ Tokens/sec (source+target, without padding) of one epoch of
+    Transformer.fit on the pairs, for each set of fit arguments of modes """
+    if modes is None:
+        modes = {"fp32": {},
+                 "bf16": {"mixed_precision": True},
+                 "bf16_accumulation_4x16": {"mixed_precision": True, "accumulation_steps": 4, "batch_size": 16},
+                 "bf16_bucketing": {"mixed_precision": True, "bucketing": True}}
+    n_tokens = sum(len(source)+len(target)+2 for source, target in pairs) # <eos> included
+    save_path = os.path.join(tempfile.mkdtemp(), "transformer.pt")
+    results = {}
+    for name, kwargs in modes.items():
+        model = synthetic_transformer(device=device)
+        t0 = time.time()
+        model.fit(pairs, pairs[:16], 1, warmup_step=4000, save_path=save_path, **kwargs)
+        synchronize(device)
+        results[name] = n_tokens/(time.time()-t0)
+    return results
+
+
+if __name__ == "__main__":
+    # usage: python benchmarks.py [device]
+    device = sys.argv[1] if len(sys.argv) > 1 else ("cuda" if torch.cuda.is_available() else "cpu")
+    print("scaled_dot_product_attention available:", hasattr(F, "scaled_dot_product_attention"))
+
+    print("= = = fused attention, max abs difference to the head by head reference = = =")
+    print({k: "%.2e" % v for k, v in check_fused(device=device).items()})
+
+    print("= = = masked self-attention = = =")
+    for backward in [False, True]:
+        for B, T in [(1, 24), (64, 24), (64, 128), (16, 512)]:
+            results = attention_latency(B, T, device=device, backward=backward)
+            print("backward" if backward else "forward", "B", B, "T", T, ":",
+                  {k: round(v, 3) for k, v in results.items()})
+
+    print("= = = positional encoding = = =")
+    print({k: round(v, 3) for k, v in positional_encoding_latency(device=device).items()})
+    print({k: round(v, 1) for k, v in decoding_latency(64, 24, device).items()})
+
+    print("= = = test set evaluation (sec) = = =")
+    model = synthetic_transformer(device=device)
+    print({k: round(v, 3) for k, v in evaluation_latency(model, synthetic_pairs(5000)).items()})
+
+    print("= = = training modes (tokens/sec) = = =")
+    print({k: round(v) for k, v in training_throughput(synthetic_pairs(3000), device).items()})
+
+    print("= = = Transformer (ms) = = =")
+    for B, T in [(64, 24), (64, 48)]:
+        print("B", B, "T", T, ":", {k: round(v, 1) for k, v in model_latency(B, T, device).items()})
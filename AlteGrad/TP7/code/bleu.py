@@ -0,0 +1,169 @@
+""" Corpus BLEU on integer token ids
+
+Same score as nltk.translate.bleu_score.corpus_bleu (uniform weights, no
+smoothing, one reference per hypothesis) on the corresponding words, as long
+as ids and words are in one-to-one correspondence. Sentences are given as
+padded (N, T) integer arrays with their lengths: the n-grams of all the
+sentences are counted at once with numpy, and the corpus can be split into
+shards counted in parallel processes (the statistics are additive).
+"""
+import sys
+import math
+import time
+import numpy as np
+from multiprocessing import Pool
+
+
+def ngram_keys(sentences, lengths, n, base):
+    """ Integer keys of all the n-grams of a batch of sentences
+
+    Args:
+        sentences (np.ndarray): Padded token ids (N, T)
+        lengths (np.ndarray): Lengths of the sentences (N,)
+        n (int): Order of the n-grams.
+        base (int): Larger than all the token ids.
+
+    Returns:
+        The keys (one int64 per n-gram, equal keys for equal n-grams) and the
+        index of the sentence of each n-gram.
+    """
+    N, T = sentences.shape
+    if T < n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    sentences = sentences.astype(np.int64)
+    keys = np.zeros((N, T-n+1), dtype=np.int64)
+    for k in range(n):
+        keys = keys*base + sentences[:, k:T-n+1+k]
+    valid = np.arange(T-n+1)[None, :] < (lengths[:, None]-n+1)
+
+    return keys[valid], np.nonzero(valid)[0]
+
+
+def clipped_matches(hypotheses, hyp_lengths, references, ref_lengths, n):
+    """ Number of n-grams of the hypotheses, each one counted at most as many
+    times as it occurs in the reference of its sentence (summed over the
+    sentences) """
+    if hypotheses.size == 0 or references.size == 0:
+        return 0
+
+    base = int(max(hypotheses.max(), references.max())) + 1
+    if base**n >= 2**63:
+        raise ValueError("Token ids too large for %i-gram keys" % n)
+
+    hyp_keys, hyp_idx = ngram_keys(hypotheses, hyp_lengths, n, base)
+    ref_keys, ref_idx = ngram_keys(references, ref_lengths, n, base)
+    if len(hyp_keys) == 0 or len(ref_keys) == 0:
+        return 0
+
+    # dense ids of the n-grams, so that (sentence, n-gram) pairs fit an int64
+    n_grams, inverse = np.unique(np.concatenate([hyp_keys, ref_keys]), return_inverse=True)
+    inverse = inverse.reshape(-1)
+    hyp_pairs = hyp_idx*len(n_grams) + inverse[:len(hyp_keys)]
+    ref_pairs = ref_idx*len(n_grams) + inverse[len(hyp_keys):]
+
+    hyp_pairs, hyp_counts = np.unique(hyp_pairs, return_counts=True)
+    ref_pairs, ref_counts = np.unique(ref_pairs, return_counts=True)
+    _, hyp_pos, ref_pos = np.intersect1d(hyp_pairs, ref_pairs, assume_unique=True, return_indices=True)
+
+    return int(np.minimum(hyp_counts[hyp_pos], ref_counts[ref_pos]).sum())
+
+
+def bleu_stats(hypotheses, hyp_lengths, references, ref_lengths, max_n=4):
+    """ Additive statistics of corpus BLEU on a shard of sentences
+
+    Args:
+        hypotheses (np.ndarray): Padded token ids (N, T_h)
+        hyp_lengths (np.ndarray): Lengths of the hypotheses (N,)
+        references (np.ndarray): Padded token ids (N, T_r)
+        ref_lengths (np.ndarray): Lengths of the references (N,)
+        max_n (int): Maximum order of the n-grams.
+
+    Returns:
+        (max_n+2,) int64 array: the clipped matches of order 1 to max_n, then
+        the total hypotheses and references lengths (the number of n-grams
+        of the hypotheses follows from the lengths, see ngram_totals).
+    """
+    stats = [clipped_matches(hypotheses, hyp_lengths, references, ref_lengths, n)
+             for n in range(1, max_n+1)]
+
+    return np.array(stats + [hyp_lengths.sum(), ref_lengths.sum()], dtype=np.int64)
+
+
+def ngram_totals(hyp_lengths, max_n):
+    """ Number of n-grams of the hypotheses, for n in 1..max_n (at least one
+    per sentence, as in nltk) """
+    return [int(np.maximum(hyp_lengths-n+1, 1).sum()) for n in range(1, max_n+1)]
+
+
+def corpus_bleu_ids(hypotheses, hyp_lengths, references, ref_lengths, max_n=4, n_jobs=1):
+    """ Corpus BLEU of the hypotheses (one reference each)
+
+    Args:
+        hypotheses (np.ndarray): Padded token ids (N, T_h)
+        hyp_lengths (np.ndarray): Lengths of the hypotheses (N,)
+        references (np.ndarray): Padded token ids (N, T_r)
+        ref_lengths (np.ndarray): Lengths of the references (N,)
+        max_n (int): Maximum order of the n-grams (weights 1/max_n).
+        n_jobs (int): If larger than 1, the sentences are split into n_jobs
+            shards whose statistics are computed by a pool of processes.
+    """
+    hypotheses, references = np.asarray(hypotheses), np.asarray(references)
+    hyp_lengths, ref_lengths = np.asarray(hyp_lengths), np.asarray(ref_lengths)
+    if n_jobs > 1 and len(hypotheses) >= n_jobs:
+        shards = [(hypotheses[idx], hyp_lengths[idx], references[idx], ref_lengths[idx], max_n)
+                  for idx in np.array_split(np.arange(len(hypotheses)), n_jobs)]
+        with Pool(n_jobs) as pool:
+            stats = np.sum(pool.starmap(bleu_stats, shards), 0)
+    else:
+        stats = bleu_stats(hypotheses, hyp_lengths, references, ref_lengths, max_n)
+
+    matches, (hyp_length, ref_length) = stats[:max_n], stats[max_n:]
+    if matches[0] == 0:
+        return 0
+
+    # orders without any match count as the smallest positive float (as
+    # nltk without smoothing function, with a warning)
+    precisions = [m/t if m > 0 else sys.float_info.min
+                  for m, t in zip(matches, ngram_totals(hyp_lengths, max_n))]
+    if hyp_length > ref_length:
+        brevity_penalty = 1
+    else:
+        brevity_penalty = math.exp(1 - ref_length/hyp_length)
+
+    return brevity_penalty * math.exp(math.fsum(math.log(p)/max_n for p in precisions))
+
+
+if __name__ == "__main__":
+    # usage: python bleu.py [n_sentences]
+    # checks the score against nltk on random sentences and compares the times
+    import warnings
+    from nltk.translate.bleu_score import corpus_bleu
+
+    N = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.RandomState(0)
+    references = rng.randint(4, 40, (N, 23))
+    hypotheses = np.where(rng.rand(N, 23) < 0.6, references, rng.randint(4, 40, (N, 23)))
+    ref_lengths = rng.randint(1, 24, N)
+    hyp_lengths = np.clip(ref_lengths + rng.randint(-3, 4, N), 0, 23)
+
+    t0 = time.time()
+    words = np.array(["w%i" % idx for idx in range(40)], dtype=object)
+    expected = corpus_bleu([[words[ref[:l]].tolist()] for ref, l in zip(references, ref_lengths)],
+                           [words[hyp[:l]].tolist() for hyp, l in zip(hypotheses, hyp_lengths)])
+    print("nltk: %.6f in %.3f s" % (expected, time.time()-t0))
+
+    for n_jobs in [1, 4]:
+        t0 = time.time()
+        score = corpus_bleu_ids(hypotheses, hyp_lengths, references, ref_lengths, n_jobs=n_jobs)
+        print("ids, %i job(s): %.6f in %.3f s" % (n_jobs, score, time.time()-t0))
+        assert abs(score-expected) < 1e-9
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # nltk warns about orders without matches
+        for ref, hyp in [([[4, 5]], [[4, 6]]), ([[4, 41, 5]], [[4, 5, 6]]), ([[4, 5, 6, 7, 8]], [[4, 5, 6, 9, 8]]), ([[4]], [[5]])]:
+            expected = corpus_bleu([[r] for r in ref], hyp)
+            score = corpus_bleu_ids(np.array(hyp), np.array([len(h) for h in hyp]),
+                                    np.array(ref), np.array([len(r) for r in ref]))
+            assert abs(score-expected) < 1e-12, (score, expected)
+    print("same scores as nltk")
@@ -0,0 +1,101 @@
+# TP4/code/pair_store.py and TP7/code/pair_store.py are two copies of the same file (each lab is run from its own folder):
+# keep them identical, any change to one must be applied to the other
+
+import os
+import numpy as np
+
+import torch
+from torch.utils import data
+
+# binary pair store: the source (resp. target) sentences of a pairs_*_ints.txt file are concatenated into a flat
+# int32 array, and sentence i is tokens[offsets[i]:offsets[i+1]]. The arrays are saved as .npy and memory-mapped
+
+SUFFIXES = ['_source', '_source_offsets', '_target', '_target_offsets']
+
+
+def flatten(sentences):
+    '''list of strings of space separated integers -> flat int32 array of all the integers, (n+1) int64 offsets'''
+    lengths = np.array([elt.count(' ')+1 if elt else 0 for elt in sentences],dtype=np.int64)
+    offsets = np.zeros(len(sentences)+1,dtype=np.int64)
+    np.cumsum(lengths,out=offsets[1:])
+    tokens = np.array(' '.join([elt for elt in sentences if elt]).split(),dtype=np.int32)
+    return tokens, offsets
+
+
+def convert_pairs(path_to_txt, prefix):
+    '''converts a pairs_*_ints.txt file (one pair per line, source and target separated by a tab) into a pair store'''
+    with open(path_to_txt, 'r', encoding='utf-8') as file:
+        pairs_tmp = [elt.split('\t') for elt in file.read().splitlines()]
+    source, source_offsets = flatten([' '.join(elt[0].split()) for elt in pairs_tmp])
+    target, target_offsets = flatten([' '.join(elt[1].split()) for elt in pairs_tmp])
+    for suffix, array in zip(SUFFIXES,[source,source_offsets,target,target_offsets]):
+        np.save(prefix+suffix+'.npy',array)
+
+
+class PairStore(data.Dataset):
+    '''memory-mapped pair store, returns (source,target) int32 tensors which share memory with the mapping (no copy)
+    the collate function is responsible for the conversion to int64'''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.open()
+
+    def open(self):
+        # 'c' (copy-on-write) rather than 'r': torch.from_numpy warns on read-only arrays, and the file is never written
+        self.source, self.source_offsets, self.target, self.target_offsets = \
+            [np.load(self.prefix+suffix+'.npy',mmap_mode='c') for suffix in SUFFIXES]
+
+    def __getstate__(self):
+        # DataLoader workers started with 'spawn' receive a pickled copy of the dataset:
+        # only the prefix is sent, each worker maps the files itself (the arrays are not copied)
+        return {'prefix':self.prefix}
+
+    def __setstate__(self, state):
+        self.prefix = state['prefix']
+        self.open()
+
+    def __len__(self):
+        return len(self.source_offsets)-1
+
+    def __getitem__(self, idx):
+        source = self.source[self.source_offsets[idx]:self.source_offsets[idx+1]]
+        target = self.target[self.target_offsets[idx]:self.target_offsets[idx+1]]
+        return torch.from_numpy(source), torch.from_numpy(target)
+
+    def lengths(self):
+        '''source and target lengths of all the pairs, computed from the offsets (used by the bucketed batch sampler)'''
+        return np.diff(self.source_offsets), np.diff(self.target_offsets)
+
+
+def pad_with_eos(sequences,eos_token,padding_token):
+    '''(batch,max_len+1) LongTensor of the sequences followed by <eos> and padded, and the (batch,) lengths (<eos> included)
+    same result as pad_sequence([torch.cat((elt,[eos])) for elt in sequences],batch_first=True), but with a single
+    concatenation and a masked copy instead of one concatenation and one copy per sequence'''
+    lengths = torch.LongTensor([len(elt) for elt in sequences])
+    batch = torch.full((len(sequences),int(lengths.max())+1),padding_token,dtype=torch.long)
+    batch[torch.arange(batch.size(1)).unsqueeze(0) < lengths.unsqueeze(1)] = torch.cat(sequences).long()
+    batch[torch.arange(len(sequences)),lengths] = eos_token
+    return batch, lengths+1
+
+
+class PadCollate(object):
+    '''collate function returning (batch_source,batch_target,source_lengths) as (batch,seq) LongTensors, see pad_with_eos
+    unlike a bound method of the model, instances are cheap to pickle (DataLoader workers)'''
+    def __init__(self, eos_token, padding_token):
+        self.eos_token = eos_token
+        self.padding_token = padding_token
+
+    def __call__(self, my_list):
+        batch_source, source_lengths = pad_with_eos([elt[0] for elt in my_list],self.eos_token,self.padding_token)
+        batch_target, _ = pad_with_eos([elt[1] for elt in my_list],self.eos_token,self.padding_token)
+        return batch_source, batch_target, source_lengths
+
+
+def load_pair_store(path_to_data, train_or_test):
+    '''loads pairs_<train_or_test>_ints from its pair store, the store is (re)built from the .txt file if needed'''
+    path_to_txt = path_to_data + 'pairs_' + train_or_test + '_ints.txt'
+    prefix = path_to_data + 'pairs_' + train_or_test + '_ints'
+    paths = [prefix+suffix+'.npy' for suffix in SUFFIXES]
+    if not all(os.path.exists(elt) for elt in paths) or \
+       (os.path.exists(path_to_txt) and min(os.path.getmtime(elt) for elt in paths) < os.path.getmtime(path_to_txt)):
+        convert_pairs(path_to_txt, prefix)
+    return PairStore(prefix)
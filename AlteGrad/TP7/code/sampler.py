@@ -0,0 +1,91 @@
+# TP4/code/sampler.py and TP7/code/sampler.py are two copies of the same file (each lab is run from its own folder):
+# keep them identical, any change to one must be applied to the other
+
+import numpy as np
+from torch.utils import data
+
+
+def pair_lengths(dataset):
+    '''(source,target) lengths of the pairs of a dataset, <eos> included (as after my_pad)
+    uses dataset.lengths if the dataset provides it, otherwise dataset.pairs'''
+    if hasattr(dataset,'lengths'):
+        source_lengths, target_lengths = dataset.lengths()
+    else:
+        source_lengths = np.array([len(source) for source,_ in dataset.pairs])
+        target_lengths = np.array([len(target) for _,target in dataset.pairs])
+    return source_lengths+1, target_lengths+1
+
+
+class BucketBatchSampler(data.Sampler):
+    '''batch sampler grouping pairs of similar lengths, to be passed to DataLoader(batch_sampler=...)
+    at each epoch, the pairs are shuffled and split into pools of 'pool_size' batches; each pool is sorted by
+    (source,target) length and cut into batches, and the order of all the batches is shuffled
+    batches contain 'batch_size' pairs, or, if 'max_tokens' is given, as many pairs as possible such that
+    the padded batch contains at most 'max_tokens' source+target tokens
+    pool_size=1 gives ordinary random batches'''
+    def __init__(self, source_lengths, target_lengths, batch_size=64, max_tokens=None, pool_size=100,
+                 shuffle=True, max_size=None, seed=0):
+        self.source_lengths = np.asarray(source_lengths)
+        self.target_lengths = np.asarray(target_lengths)
+        if max_size is not None: # sequences truncated by the collate function
+            self.source_lengths = np.minimum(self.source_lengths,max_size)
+            self.target_lengths = np.minimum(self.target_lengths,max_size)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self.make_batches(self.epoch)
+
+    def cut(self, idxs):
+        '''cuts an array of (sorted) indexes into batches'''
+        if self.max_tokens is None:
+            return [idxs[i:i+self.batch_size] for i in range(0,len(idxs),self.batch_size)]
+        batches = []
+        start = 0
+        max_source = max_target = 0
+        for pos, idx in enumerate(idxs):
+            new_source = max(max_source,self.source_lengths[idx])
+            new_target = max(max_target,self.target_lengths[idx])
+            if pos > start and (pos-start+1)*(new_source+new_target) > self.max_tokens:
+                batches.append(idxs[start:pos])
+                start = pos
+                new_source, new_target = self.source_lengths[idx], self.target_lengths[idx]
+            max_source, max_target = new_source, new_target
+        batches.append(idxs[start:])
+        return batches
+
+    def make_batches(self, epoch):
+        rng = np.random.RandomState(self.seed+epoch)
+        n_pairs = len(self.source_lengths)
+        order = rng.permutation(n_pairs) if self.shuffle else np.arange(n_pairs)
+        pool = self.pool_size*(self.batch_size if self.max_tokens is None else
+                               max(1,self.max_tokens//int(np.mean(self.source_lengths+self.target_lengths))))
+        batches = []
+        for start in range(0,n_pairs,pool):
+            idxs = order[start:start+pool]
+            if self.pool_size > 1:
+                # stable sort by source length, then target length (np.lexsort sorts by the last key first)
+                idxs = idxs[np.lexsort((self.target_lengths[idxs],self.source_lengths[idxs]))]
+            batches.extend(self.cut(idxs))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return [batch.tolist() for batch in batches]
+
+    def padding_ratio(self):
+        '''fraction of padding tokens (source and target) in the batches of the current epoch'''
+        n_real = n_total = 0
+        for batch in self.batches:
+            n_real += self.source_lengths[batch].sum() + self.target_lengths[batch].sum()
+            n_total += len(batch)*(self.source_lengths[batch].max() + self.target_lengths[batch].max())
+        return 1 - float(n_real)/n_total
+
+    def __iter__(self):
+        batches = self.batches
+        self.epoch += 1
+        self.batches = self.make_batches(self.epoch) # batches of the next epoch
+        return iter(batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -7,18 +7,20 @@ from torch.nn import Module, ModuleList, Linear,\
         Parameter
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
-from torch.nn.utils.rnn import pad_sequence
 from torch.nn.init import xavier_uniform_, constant_
 
 import json
 from tqdm import tqdm
 
-from nltk.translate.bleu_score import corpus_bleu
 from nltk import word_tokenize
 
 import os
 import math
 
+from sampler import BucketBatchSampler, pair_lengths
+from pair_store import load_pair_store, pad_with_eos
+from bleu import corpus_bleu_ids
+
 padding_token = '0'
 oov_token = '1'
 sos_token = '2' # start of sentence, only needed for the target sentence
@@ -31,11 +33,12 @@ class Transformer(Module):
     ARGS = ["N_stacks_encoder", "N_stacks_decoder", "N_heads",
             "dk", "dv","dmodel", "ff_inner_dim", "vocab_source",
             "vocab_target_inv", "max_size", "device","EOS_token",
-            "PAD_token", "SOS_token"]
+            "PAD_token", "SOS_token", "fused_attention", "positional_encoding"]
     def __init__(self, N_stacks_encoder, N_stacks_decoder, N_heads, 
                  dk, dv, dmodel, ff_inner_dim, vocab_source,
                  vocab_target_inv, max_size, device, EOS_token=3, 
-                 PAD_token=0, SOS_token=2, OOV_token=1):
+                 PAD_token=0, SOS_token=2, OOV_token=1, fused_attention=False,
+                 positional_encoding="sinusoidal"):
         """
         Args:
             N_stacks_encoder (int): Number of encoder stacks.
@@ -52,6 +55,15 @@ class Transformer(Module):
             EOS_token (int): Position of the EOS token in vocabulary.
             PAD_token (int): Position of the PAD token in vocabulary.
             SOS_token (int): Position of the SOS token in vocabulary.
+            fused_attention (bool): If True, FusedMultiHeadAttention (per-head
+                attention) is used instead of MultiHeadAttention (a single
+                attention over the concatenated heads). The two are different
+                models: weights cannot be exchanged.
+            positional_encoding (str): "sinusoidal" (fixed table added to
+                the embeddings), "learned" (table added to the embeddings,
+                initialized with the sinusoidal one and trained) or "rotary"
+                (queries and keys of the self-attentions are rotated by an
+                angle proportional to their position).
         """
         super(Transformer, self).__init__()
         self.max_size = max_size
@@ -68,19 +80,30 @@ class Transformer(Module):
         self.N_stacks_encoder = N_stacks_encoder
         self.N_stacks_decoder = N_stacks_decoder
         self.N_heads = N_heads
+        self.fused_attention = fused_attention
+        self.positional_encoding = positional_encoding
+        rotary_size = max_size if positional_encoding == "rotary" else None
 
         self.vocab_source = vocab_source
         self.vocab_target_inv = vocab_target_inv
         self.vocab_size_target = len(vocab_target_inv) + 4
+        # index -> word, looked up with numpy by targetInts_to_nl
+        self.target_words = np.empty(self.vocab_size_target, dtype=object)
+        for idx, word in vocab_target_inv.items():
+            self.target_words[int(idx)] = word
+        self.target_words[[PAD_token, OOV_token, EOS_token, SOS_token]] = ['<PAD>', '<OOV>', '<EOS>', '<SOS>']
         self.source_embedding = Embedding(len(vocab_source)+4, dmodel, PAD_token).to(device)
         self.target_embedding = Embedding(self.vocab_size_target, dmodel, PAD_token).to(device)
         self.encoder = Encoder(N_stacks_encoder, N_heads, dk, dv, dmodel,
-                               ff_inner_dim, device)
+                               ff_inner_dim, device, fused_attention, rotary_size)
         self.decoder = Decoder(N_stacks_decoder, N_heads, dk, dv, dmodel,
-                               ff_inner_dim, device)
+                               ff_inner_dim, device, fused_attention, rotary_size)
         self.output_linear = Linear(dmodel, self.vocab_size_target).to(device)
 
-        self.PE_tensor = self.build_encoding(max_size, dmodel).to(device)
+        # additive forward mask of the decoder self-attention, built once:
+        # -inf above the diagonal (not saved with the model)
+        self.register_buffer("causal_mask", torch.full((max_size, max_size), float("-inf")).triu(1).to(device),
+                             persistent=False)
 
         self.device = device
 
@@ -92,35 +115,90 @@ class Transformer(Module):
             else:
                 constant_(p.data, 0.0)
 
-    def forward(self, x, y=None):
+        # positional encoding table (max_size, dmodel), a buffer (or a
+        # parameter) to move with the model and be saved with it
+        PE_tensor = self.build_encoding(max_size, dmodel).to(device)
+        if positional_encoding == "sinusoidal":
+            self.register_buffer("PE_tensor", PE_tensor)
+        elif positional_encoding == "learned":
+            self.PE_tensor = Parameter(PE_tensor)
+        elif positional_encoding == "rotary":
+            self.register_buffer("PE_tensor", None)
+        else:
+            raise ValueError("Unknown positional encoding: %s" % positional_encoding)
+
+    def forward(self, x, y=None, use_cache=True, sync_every=4):
         """ Forward pass of the transformer
 
         Args:
             x (torch.Tensor): Source sentence, tokenized, (B x T)
             y (torch.Tensor): If defined, teacher forcing is used to process
                 rapidly the decoding. (B x T_target)
+            use_cache (bool): Greedy decoding only. If True, the decoder is
+                run incrementally: only the newest position is processed at
+                each step, with the keys/values of the previous positions
+                (self-attention) and of x_enc (cross-attention) cached.
+                If False, the whole prefix is decoded again at each step.
+            sync_every (int): With use_cache, the sentences which have emitted
+                EOS_token are tracked on the device, and checked from the host
+                every sync_every steps: decoding stops when all are finished,
+                and finished sentences are removed from the batch. The logits
+                after the EOS_token of a sentence are zeros, and the returned
+                (B, steps, vocab) tensor can be shorter than max_size-1.
         """
         ### YOUR CODE HERE ###
         x_emb = self.source_embedding(x) # (B, T, dmodel)
-        x_input = x_emb + self.PE_tensor[:x_emb.size()[1]].float() # (B, T, dmodel)
-        x_enc = self.encoder(x_input) # (B, T, dmodel)
+        x_input = self.add_position(x_emb) # (B, T, dmodel)
+        x_mask = self.padding_mask(x) # (B, 1, T)
+        x_enc = self.encoder(x_input, x_mask) # (B, T, dmodel)
 
         if self.training and not y is None:
             ### YOUR CODE HERE ###
             y_shifted = self.shift(y)
             y_emb = self.target_embedding(y_shifted) # (B, T_target+1, dmodel)
-            y_input = y_emb + self.PE_tensor[:y_emb.size()[1]].float() # (B, T_target+1, dmodel)
-            _, y_dec = self.decoder(x_enc, y_input) # (B, T_target+1, dmodel) 
+            y_input = self.add_position(y_emb) # (B, T_target+1, dmodel)
+            y_mask = self.causal_mask[:y_emb.size(1), :y_emb.size(1)]
+            _, y_dec = self.decoder(x_enc, y_input, x_mask, y_mask) # (B, T_target+1, dmodel) 
             out = self.output_linear(y_dec)[:,:-1,:]
 
+        elif use_cache:
+            with torch.no_grad():
+                caches = self.decoder.init_cache(x_enc, self.max_size, x_mask)
+                y = torch.ones((x.size(0), 1), dtype=torch.long).to(self.device) * self.SOS_token # (B, 1)
+                rows = torch.arange(x.size(0), device=x.device) # rows of out of the sentences still decoded
+                finished = torch.zeros(x.size(0), dtype=torch.bool, device=x.device)
+                out = torch.zeros((x.size(0), self.max_size-1, self.vocab_size_target), device=x.device)
+                for i in range(1,self.max_size):
+                    y_emb = self.target_embedding(y[:,-1:]) # (B', 1, dmodel)
+                    y_input = self.add_position(y_emb, i-1) # (B', 1, dmodel)
+                    y_dec = self.decoder.forward_step(y_input, caches) # (B', 1, dmodel)
+                    logits = self.output_linear(y_dec)[:,0,:] # (B', vocab)
+                    out[rows, i-1] = logits.masked_fill(finished.unsqueeze(1), 0.)
+                    out_idx = logits.argmax(-1) # (B')
+                    finished = finished | (out_idx == self.EOS_token)
+                    y = torch.cat([y, out_idx.view(-1,1)], -1) # (B', i+1)
+
+                    if i % sync_every == 0:
+                        active = (~finished).nonzero().view(-1) # the only synchronization
+                        if len(active) == 0:
+                            break
+                        if len(active) < len(rows):
+                            rows, y, finished = rows[active], y[active], finished[active]
+                            self.decoder.select_cache(caches, active)
+
+                # the decoder is causal: same logits (up to EOS_token) as the
+                # last step of the uncached loop below, which decodes the whole
+                # prefix again
+                out = out[:,:i] # (B, steps, vocab)
+
         else:
             ### YOUR CODE HERE ###
             with torch.no_grad():
                 y = torch.ones((x.size(0), 1), dtype=torch.long).to(self.device) * self.SOS_token # (B, 1)
                 for i in range(1,self.max_size):
                     y_emb = self.target_embedding(y) # (B, i, dmodel)
-                    y_input = y_emb + self.PE_tensor[:i].float() # (B, i, dmodel)
-                    _, y_dec = self.decoder(x_enc, y_input) # (B, i, dmodel)
+                    y_input = self.add_position(y_emb) # (B, i, dmodel)
+                    _, y_dec = self.decoder(x_enc, y_input, x_mask, self.causal_mask[:i, :i]) # (B, i, dmodel)
                     out = self.output_linear(y_dec) # (B, i, vocab)
                     out_idx = out[:,-1,:].argmax(-1) # (B)
 
@@ -145,61 +223,117 @@ class Transformer(Module):
         return out
 
     def fit(self, pairs_train, pairs_test, n_epochs, warmup_step, patiente=5,
-            batch_size=64, seed=42, save_path="./trained_transformer.pt"):
+            batch_size=64, seed=42, save_path="./trained_transformer.pt",
+            bucketing=False, max_tokens=None, accumulation_steps=1,
+            mixed_precision=False, torch_compile=False, log_every=10):
         """ Trains the network
 
         Args:
-            train_loader (torch.utils.data.DataLoader)
-            test_loader (torch.utils.data.DataLoader)
+            pairs_train (list or torch.utils.data.Dataset): Training pairs, or
+                a dataset of pairs (e.g. a pair_store.PairStore).
+            pairs_test (list or torch.utils.data.Dataset)
             n_epchos (int)
             lr (float)
             batch_size (int)
             seed (int)
             save_path (str)
+            bucketing (bool): If True, batches group pairs of similar lengths
+                (see sampler.BucketBatchSampler).
+            max_tokens (int): With bucketing, batches are built by token budget
+                (padded source+target tokens) instead of batch_size.
+            accumulation_steps (int): Gradients are accumulated over
+                accumulation_steps batches before each optimizer step (and
+                warmup step): the effective batch size is
+                accumulation_steps*batch_size.
+            mixed_precision (bool): If True, forward passes run under bf16
+                autocast (CPU or cuda), the loss is computed in float32.
+            torch_compile (bool): If True and available, the forward pass is
+                compiled with torch.compile (the saved weights are the same).
+            log_every (int): The progress bar (running mean of the loss,
+                tokens/sec) is refreshed every log_every batches.
         """
         torch.manual_seed(seed)
         torch.cuda.manual_seed(seed)
         np.random.seed(seed)
 
-        train_loader = DataLoader(Dataset(pairs_train), batch_size=batch_size, 
-                                  shuffle=True, collate_fn=self.my_pad)
-        test_loader = DataLoader(Dataset(pairs_test), batch_size=16, 
+        training_set = pairs_train if isinstance(pairs_train, torch.utils.data.Dataset) else Dataset(pairs_train)
+        test_set = pairs_test if isinstance(pairs_test, torch.utils.data.Dataset) else Dataset(pairs_test)
+        if bucketing:
+            source_lengths, target_lengths = pair_lengths(training_set)
+            batch_sampler = BucketBatchSampler(source_lengths, target_lengths,
+                                               batch_size, max_tokens,
+                                               max_size=self.max_size-1, seed=seed)
+            random_ratio = BucketBatchSampler(source_lengths, target_lengths,
+                                              batch_size, pool_size=1,
+                                              max_size=self.max_size-1).padding_ratio()
+            print("padding ratio: %.3f with random batches, %.3f with bucketed batches"
+                  % (random_ratio, batch_sampler.padding_ratio()))
+            train_loader = DataLoader(training_set, batch_sampler=batch_sampler,
+                                      collate_fn=self.my_pad)
+        else:
+            train_loader = DataLoader(training_set, batch_size=batch_size, 
+                                      shuffle=True, collate_fn=self.my_pad)
+        test_loader = DataLoader(test_set, batch_size=16, 
                               shuffle=False, collate_fn=self.my_pad)
 
         optimizer = torch.optim.Adam(self.parameters(), 1, betas=(0.9, 0.98), eps=1e-09)
         criteron = CrossEntropyLoss()
+        forward = torch.compile(self, dynamic=True) if torch_compile and hasattr(torch, "compile") else self
+        device_type = torch.device(self.device).type
 
         step = 1
         curr_best_loss = 10.0
         patiente_count = 0
         for epoch in range(n_epochs):
-            pbar = self.initialize_pbar(epoch, n_epochs, 136521)
-            epoch_train_loss = []
+            pbar = self.initialize_pbar(epoch, n_epochs, len(training_set))
+            # running sum of the loss, on the device: no synchronization
+            # except when the progress bar is refreshed
+            epoch_loss_sum = torch.zeros((), device=self.device)
+            n_batches = 0
             self.train()
+            optimizer.zero_grad()
+            n_tokens = 0
+            t0 = time.time()
             for i, (source, target) in enumerate(train_loader):
-                self.warmup(optimizer, warmup_step, step)
+                n_tokens += int((source != self.PAD_token).sum()) + int((target != self.PAD_token).sum())
                 source = source.to(self.device)
                 target = target.to(self.device)
 
-                pred = self.forward(source, target)
+                with torch.autocast(device_type, dtype=torch.bfloat16, enabled=mixed_precision):
+                    pred = forward(source, target)
 
-                optimizer.zero_grad()
                 mask = target.flatten() != self.PAD_token
-                loss = criteron(pred.flatten(end_dim=1)[mask, :], target.flatten()[mask])
-                loss.backward()
-                optimizer.step()
+                loss = criteron(pred.flatten(end_dim=1)[mask, :].float(), target.flatten()[mask])
+                # mean over the batches of the group (the last group of the
+                # epoch can be smaller than accumulation_steps)
+                group_size = min(accumulation_steps, len(train_loader) - (i//accumulation_steps)*accumulation_steps)
+                (loss/group_size).backward()
+                epoch_loss_sum += loss.detach()
+                n_batches += 1
+
+                if (i+1) % accumulation_steps == 0 or i+1 == len(train_loader):
+                    self.warmup(optimizer, warmup_step, step)
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    step += 1
 
                 pbar.update(source.size(0))
-                epoch_train_loss.append(loss.item())
-                pbar.set_postfix({"train_loss" : np.mean(epoch_train_loss)})
-                step += 1
+                if (i+1) % log_every == 0:
+                    pbar.set_postfix({"train_loss" : epoch_loss_sum.item()/n_batches,
+                                      "tok/s" : n_tokens/(time.time()-t0)})
 
-            if not np.mean(epoch_train_loss) < curr_best_loss - 1e-3:
+            # nan for an empty loader: counts as an epoch without improvement
+            epoch_train_loss = epoch_loss_sum.item()/n_batches if n_batches > 0 else float("nan")
+            pbar.set_postfix({"train_loss" : epoch_train_loss,
+                              "tok/s" : n_tokens/(time.time()-t0)})
+            pbar.close()
+
+            if not epoch_train_loss < curr_best_loss - 1e-3:
                 patiente_count += 1
 
             else:
                 patiente_count = 0
-                curr_best_loss = np.mean(epoch_train_loss)
+                curr_best_loss = epoch_train_loss
 
             if patiente_count >= patiente:
                 break
@@ -208,52 +342,66 @@ class Transformer(Module):
 
         self.save(save_path)
 
-    def test(self, test_loader):
+    def test(self, test_loader, n_jobs=1):
         """ tests the network on the test_loader 
 
+        Predictions and targets are cut at their first EOS_token and scored
+        with corpus BLEU on the token ids (same score as nltk corpus_bleu on
+        the words, see bleu.py).
+
         Args:
-            test_loader (torch.utils.data.DataLoader)
-            criteron (torch)
+            test_loader (torch.utils.data.DataLoader): Or the test pairs
+                (list or torch.utils.data.Dataset), which are then decoded in
+                batches of similar lengths (see sorted_loader).
+            n_jobs (int): Number of processes counting the n-grams.
         """
+        if not isinstance(test_loader, DataLoader):
+            test_loader = self.sorted_loader(test_loader)
         self.eval()
-        predictions = []
-        targets = []
+        predictions, prediction_lengths = [], []
+        targets, target_lengths = [], []
         pbar = tqdm(total=len(test_loader), unit_scale=True, desc="Testing", postfix={})
         for i, (source, target) in enumerate(test_loader):
             source = source.to(self.device)
-            predictions.extend(self.forward(source).argmax(-1).cpu().tolist())
-            targets.extend(target.tolist())
+            prediction = self.forward(source).argmax(-1) # (B, steps)
+            # same width for all the batches: decoding stops at max_size-1
+            predictions.append(F.pad(prediction, (0, self.max_size-1-prediction.size(1)), value=self.PAD_token))
+            prediction_lengths.append(self.eos_lengths(prediction))
+            targets.append(F.pad(target, (0, self.max_size-1-target.size(1)), value=self.PAD_token))
+            target_lengths.append(self.eos_lengths(target))
             pbar.update(1)
 
-        for i, prediction in enumerate(predictions):
-            new = []
-            pos = 0
-            while prediction[pos] != self.EOS_token:
-                new.append(prediction[pos])
-                pos += 1
-                if pos == self.max_size:
-                    break
-
-            predictions[i] = new
+        test_BLEU = corpus_bleu_ids(torch.cat(predictions).cpu().numpy(),
+                                    torch.cat(prediction_lengths).cpu().numpy(),
+                                    torch.cat(targets).numpy(),
+                                    torch.cat(target_lengths).numpy(),
+                                    n_jobs=n_jobs)
+        pbar.set_postfix({"test_BLEU": test_BLEU})
 
-        for i, target in enumerate(targets):
-            new = []
-            pos = 0
-            while target[pos] != self.EOS_token:
-                new.append(target[pos])
-                pos += 1
-                if pos == self.max_size:
-                    break
+        return test_BLEU
 
-            targets[i] = new
+    def eos_lengths(self, x):
+        """ Position of the first EOS_token of each sentence of x (B, T), T
+        if there is none: the lengths of the sentences without EOS_token """
+        is_eos = x == self.EOS_token
 
-        targets = [[self.targetInts_to_nl(_)] for _ in targets]
-        predictions = [self.targetInts_to_nl(_) for _ in predictions]
+        return torch.where(is_eos.any(-1), is_eos.int().argmax(-1), torch.full_like(x[:, 0], x.size(1)))
 
-        test_BLEU = corpus_bleu(targets, predictions)
-        pbar.set_postfix({"test_BLEU": test_BLEU})
+    def sorted_loader(self, pairs, batch_size=16):
+        """ DataLoader whose batches contain pairs of similar lengths (sorted
+        by source then target length), so that short batches stop decoding
+        early (see forward)
 
-        return test_BLEU
+        Args:
+            pairs (list or torch.utils.data.Dataset)
+            batch_size (int)
+        """
+        dataset = pairs if isinstance(pairs, torch.utils.data.Dataset) else Dataset(pairs)
+        source_lengths, target_lengths = pair_lengths(dataset)
+        batch_sampler = BucketBatchSampler(source_lengths, target_lengths, batch_size,
+                                           pool_size=len(dataset)//batch_size+1,
+                                           shuffle=False, max_size=self.max_size-1)
+        return DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=self.my_pad)
 
     def predict(self, sentence):
         """ Translates a sentence """
@@ -282,14 +430,12 @@ class Transformer(Module):
         """ my_list is a list of tuples of the form [(tensor_s_1,tensor_t_1),...,(tensor_s_batch,tensor_t_batch)]
         the <eos> token is appended to each sequence before padding
         https://pytorch.org/docs/stable/nn.html#torch.nn.utils.rnn.pad_sequence """
-        batch_source = pad_sequence([torch.cat((elt[0],torch.LongTensor([self.EOS_token])))
-                      for elt in my_list],
-                                    batch_first=True,
-                                    padding_value=self.PAD_token)[:,:self.max_size-1]
-        batch_target = pad_sequence([torch.cat((elt[1],torch.LongTensor([self.EOS_token])))
-                      for elt in my_list],
-                                    batch_first=True,
-                                    padding_value=self.PAD_token)[:,:self.max_size-1]
+        batch_source, _ = pad_with_eos([elt[0] for elt in my_list],
+                                       self.EOS_token, self.PAD_token)
+        batch_target, _ = pad_with_eos([elt[1] for elt in my_list],
+                                       self.EOS_token, self.PAD_token)
+        batch_source = batch_source[:,:self.max_size-1]
+        batch_target = batch_target[:,:self.max_size-1]
 
         return batch_source,batch_target 
 
@@ -305,9 +451,7 @@ class Transformer(Module):
 
     def targetInts_to_nl(self, target_ints):
         '''converts integer target sentence into target natural language'''
-        return ['<PAD>' if elt==self.PAD_token else '<OOV>' if elt==self.OOV_token \
-                else '<EOS>' if elt==self.EOS_token else '<SOS>' if elt==self.SOS_token\
-                else self.vocab_target_inv[elt] for elt in target_ints]
+        return self.target_words[np.asarray(target_ints, dtype=np.int64)].tolist()
 
     def shift(self, x):
         """ Adds SOS token to sentence """
@@ -315,6 +459,22 @@ class Transformer(Module):
 
         return x
 
+    def add_position(self, emb, start=0):
+        """ Adds the positional encoding of positions start, start+1... to
+        embeddings (B, T, dmodel). With rotary encoding, positions are
+        encoded in the attentions instead and emb is returned as is. """
+        if self.PE_tensor is None:
+            return emb
+
+        return emb + self.PE_tensor[start:start+emb.size(1)]
+
+    def padding_mask(self, x):
+        """ Additive key padding mask of a tokenized sentence (B, 1, T):
+        -inf on the PAD_token positions, 0 elsewhere """
+        mask = torch.zeros(x.size(), device=x.device).masked_fill(x == self.PAD_token, float("-inf"))
+
+        return mask.unsqueeze(1)
+
     def warmup(self, optim, warmup_step, step):
         """ Performs warmup as described in the original paper """
         for g in optim.param_groups:
@@ -336,25 +496,32 @@ class Transformer(Module):
             attrs["device"] = device
 
         new = cls(**attrs) 
+        if new.PE_tensor is not None:
+            # models saved before PE_tensor was registered do not contain it
+            state_dict.setdefault("PE_tensor", new.PE_tensor)
         new.load_state_dict(state_dict)
 
         return new
 
     @staticmethod
     def build_encoding(size, dimension):
-        """ Builds a tensor for positional encoding 
+        """ Builds a tensor for positional encoding (size, dimension), float32
+
+        Columns 2i and 2i+1 are sin(pos/10000**(2i/dimension)) and
+        cos(pos/10000**((2i+1)/dimension)): the exponent of the cosines
+        differs from the original paper, but trained models depend on it.
 
         Args:
             size (int): max size of a sentene.
             dimension (int): representation dimentionality in the network.
         """
-        pos = torch.arange(size).view(-1,1)
-        dim = []
-        for _ in range(int(dimension/2)):
-            dim.append(np.sin(pos/(10000**(2*_/dimension))))
-            dim.append(np.cos(pos/(10000**((2*_+1)/dimension))))
+        pos = torch.arange(size, dtype=torch.float).view(-1,1)
+        exponents = torch.arange(dimension//2*2, dtype=torch.float)/dimension # 2i/d, (2i+1)/d
+        angles = pos/10000**exponents # (size, dimension)
+        angles[:, 0::2] = angles[:, 0::2].sin()
+        angles[:, 1::2] = angles[:, 1::2].cos()
 
-        return torch.cat(dim, 1)
+        return angles
 
     @staticmethod
     def initialize_pbar(epoch, epochs, its_per_epochs):
@@ -369,7 +536,8 @@ class Transformer(Module):
 
 
 class Encoder(Sequential):
-    def __init__(self, N_stacks, N_heads, dk, dv, dmodel, ff_inner_dim, device):
+    def __init__(self, N_stacks, N_heads, dk, dv, dmodel, ff_inner_dim, device,
+                 fused_attention=False, rotary_size=None):
         """ Initializes the encoder.
 
         Args:
@@ -379,17 +547,33 @@ class Encoder(Sequential):
             dv (int): The dimension of the space in which values are sent.
             dmodel (int): The model dimension.
             ff_inner_dim (int): The inner dimensions of feed forward module.
+            fused_attention (bool): Use FusedMultiHeadAttention.
+            rotary_size (int): If defined, rotary positional encoding in the
+                self-attentions, for rotary_size positions.
         """
         stacks = []
         for _ in range(N_stacks):
             stacks.append(EncoderStack(N_heads, dk, dv, dmodel, ff_inner_dim,
-                                       device))
+                                       device, fused_attention, rotary_size))
 
         super(Encoder, self).__init__(*stacks)
 
+    def forward(self, x, mask=None):
+        """ Forward pass of the encoder
+
+        Args:
+            x (torch.Tensor): The source sequence (B, T, dmodel)
+            mask (torch.Tensor): Additive key padding mask (B, 1, T)
+        """
+        for module in self.children():
+            x = module(x, mask)
+
+        return x
+
 class EncoderStack(Module):
     """ One stack of encoder as shown in the original paper """
-    def __init__(self, N_heads, dk, dv, dmodel, ff_inner_dim, device):
+    def __init__(self, N_heads, dk, dv, dmodel, ff_inner_dim, device,
+                 fused_attention=False, rotary_size=None):
         """ Initializes the encoder.
 
         Args:
@@ -398,17 +582,21 @@ class EncoderStack(Module):
             dv (int): The dimension of the space in which values are sent.
             dmodel (int): The model dimension.
             ff_inner_dim (int): The inner dimensions of feed forward module.
+            fused_attention (bool): Use FusedMultiHeadAttention.
+            rotary_size (int): If defined, rotary positional encoding in the
+                self-attention, for rotary_size positions.
         """
         super(EncoderStack, self).__init__()
         self.dmodel = dmodel
-        self.attention = MultiHeadAttention(N_heads, dk, dv, dmodel, device)
+        attention = FusedMultiHeadAttention if fused_attention else MultiHeadAttention
+        self.attention = attention(N_heads, dk, dv, dmodel, device, rotary_size=rotary_size)
         self.feed_forward = FeedForward(ff_inner_dim, dmodel, device)
         #self.norm1 = LayerNorm(dmodel).to(device)
         #self.norm2 = LayerNorm(dmodel).to(device)
 
-    def forward(self, x):
+    def forward(self, x, mask=None):
         ### YOUR CODE HERE ###
-        att_layer = self.attention(x,x,x)
+        att_layer = self.attention(x,x,x,mask)
         #norm_layer = self.norm1(att_layer+x)
 
         transformed_skip = self.feed_forward(att_layer)
@@ -417,7 +605,8 @@ class EncoderStack(Module):
         return transformed_skip
 
 class Decoder(Sequential):
-    def __init__(self, N_stacks, N_heads, dk, dv, dmodel, ff_inner_dim, device):
+    def __init__(self, N_stacks, N_heads, dk, dv, dmodel, ff_inner_dim, device,
+                 fused_attention=False, rotary_size=None):
         """ Initializes the decoder.
 
         Args:
@@ -427,27 +616,78 @@ class Decoder(Sequential):
             dv (int): The dimension of the space in which values are sent.
             dmodel (int): The model dimension.
             ff_inner_dim (int): The inner dimensions of feed forward module.
+            fused_attention (bool): Use FusedMultiHeadAttention.
+            rotary_size (int): If defined, rotary positional encoding in the
+                self-attentions, for rotary_size positions.
         """
         stacks = []
         for _ in range(N_stacks):
             stacks.append(DecoderStack(N_heads, dk, dv, dmodel, ff_inner_dim,
-                                       device))
+                                       device, fused_attention, rotary_size))
 
         super(Decoder, self).__init__(*stacks)
 
-    def forward(self, x, y):
+    def forward(self, x, y, x_mask=None, y_mask=None):
         """ Forward pass of the decode
         Needs a modification from the Sequential forward to accept multiple
         inputs.
+
+        Args:
+            x (torch.Tensor): The encoded sequence (B, T, dmodel)
+            y (torch.Tensor): The shifted decoded sequence (B, T_y, dmodel)
+            x_mask (torch.Tensor): Additive key padding mask of x (B, 1, T)
+            y_mask (torch.Tensor): Additive forward mask (T_y, T_y)
         """
         for module in self.children():
-            x, y = module(x, y)
+            x, y = module(x, y, x_mask, y_mask)
 
         return x, y
 
+    def init_cache(self, x, max_len, x_mask=None):
+        """ Initializes the caches of incremental decoding, one per stack
+
+        Args:
+            x (torch.Tensor): The encoded sequence (B, T, dmodel)
+            max_len (int): Maximum number of decoded positions.
+            x_mask (torch.Tensor): Additive key padding mask of x (B, 1, T)
+        """
+        return [module.init_cache(x, max_len, x_mask) for module in self.children()]
+
+    def forward_step(self, y, caches):
+        """ Decodes the newest position only
+
+        Args:
+            y (torch.Tensor): The newest position of the shifted decoded
+                sequence (B, 1, dmodel)
+            caches (list): Output of init_cache, updated in place.
+
+        Returns:
+            (B, 1, dmodel) tensor
+        """
+        for module, cache in zip(self.children(), caches):
+            y = module.forward_step(y, cache)
+
+        return y
+
+    def select_cache(self, caches, idx):
+        """ Keeps the rows idx of the caches (in place), to remove finished
+        sentences from the batch
+
+        Args:
+            caches (list): Output of init_cache.
+            idx (torch.Tensor): Indexes of the rows to keep.
+        """
+        for cache in caches:
+            cache["self"]["k"] = cache["self"]["k"][idx]
+            cache["self"]["v"] = cache["self"]["v"][idx]
+            cache["cross"] = tuple(elt[idx] for elt in cache["cross"])
+            if cache["mask"] is not None:
+                cache["mask"] = cache["mask"][idx]
+
 class DecoderStack(Module):
     """ One stack of decoder as shown in the original paper """
-    def __init__(self, N_heads, dk, dv, dmodel, ff_inner_dim, device):
+    def __init__(self, N_heads, dk, dv, dmodel, ff_inner_dim, device,
+                 fused_attention=False, rotary_size=None):
         """ Initializes the deocder stack.
 
         Args:
@@ -456,28 +696,35 @@ class DecoderStack(Module):
             dv (int): The dimension of the space in which values are sent.
             dmodel (int): The model dimension.
             ff_inner_dim (int): The inner dimensions of feed forward module.
+            fused_attention (bool): Use FusedMultiHeadAttention.
+            rotary_size (int): If defined, rotary positional encoding in the
+                self-attention (not in the cross-attention), for rotary_size
+                positions.
         """
         super(DecoderStack, self).__init__()
         self.dmodel = dmodel
-        self.attention_1 = MultiHeadAttention(N_heads, dk, dv, dmodel, device)
-        self.attention_2 = MultiHeadAttention(N_heads, dk, dv, dmodel, device)
+        attention = FusedMultiHeadAttention if fused_attention else MultiHeadAttention
+        self.attention_1 = attention(N_heads, dk, dv, dmodel, device, rotary_size=rotary_size)
+        self.attention_2 = attention(N_heads, dk, dv, dmodel, device)
         self.feed_forward = FeedForward(ff_inner_dim, dmodel, device)
         #self.norm1 = LayerNorm(dmodel).to(device)
         #self.norm2 = LayerNorm(dmodel).to(device)
         #self.norm3 = LayerNorm(dmodel).to(device)
 
-    def forward(self, x, y):
+    def forward(self, x, y, x_mask=None, y_mask=None):
         """ Forward pass of one decoder stack
 
         Args:
             x (torch.tensor): The encoded sequence (B, T, dmodel)
-            y (torch.tensor): The shifted decoded sequence (B, T, dmodel)
+            y (torch.tensor): The shifted decoded sequence (B, T_y, dmodel)
+            x_mask (torch.Tensor): Additive key padding mask of x (B, 1, T)
+            y_mask (torch.Tensor): Additive forward mask (T_y, T_y)
         """
         ### YOUR CODE HERE ###
-        dec_output_1 = self.attention_1(y,y,y,maskout=True)
+        dec_output_1 = self.attention_1(y,y,y,y_mask)
         #norm_layer_1 = self.norm1(dec_output_1+y)
 
-        dec_output_2 = self.attention_2(dec_output_1,x,x)
+        dec_output_2 = self.attention_2(dec_output_1,x,x,x_mask)
         #norm_layer_2 = self.norm2(dec_output_2+norm_layer_1)
 
         transformed_skip = self.feed_forward(dec_output_2)
@@ -485,9 +732,53 @@ class DecoderStack(Module):
 
         return x, transformed_skip
 
+    def init_cache(self, x, max_len, x_mask=None):
+        """ Cache of incremental decoding: the cross-attention keys/values
+        of the encoded sequence, computed once, and preallocated buffers for
+        the self-attention keys/values of the decoded positions
+
+        Args:
+            x (torch.Tensor): The encoded sequence (B, T, dmodel)
+            max_len (int): Maximum number of decoded positions.
+            x_mask (torch.Tensor): Additive key padding mask of x (B, 1, T)
+        """
+        return {"self": self.attention_1.init_cache(x.size(0), max_len, x.dtype),
+                "cross": self.attention_2.project_kv(x, x),
+                "mask": x_mask}
+
+    def forward_step(self, y, cache):
+        """ Forward pass of one decoder stack on the newest position
+
+        Args:
+            y (torch.Tensor): The newest position of the shifted decoded
+                sequence (B, 1, dmodel)
+            cache (dict): Output of init_cache, updated in place.
+        """
+        dec_output_1 = self.attention_1.forward_step(y, y, y, cache["self"])
+        dec_output_2 = self.attention_2.attend_cached(dec_output_1, cache["cross"], cache["mask"])
+
+        return self.feed_forward(dec_output_2)
+
+def rotary_table(size, dimension):
+    """ cos and sin of the angles of the rotary positional encoding
+    (2, size, dimension/2): position pos rotates the pair of features
+    (2i, 2i+1) by pos/10000**(2i/dimension) """
+    inv_freq = 10000**(-torch.arange(0, dimension, 2, dtype=torch.float)/dimension)
+    angles = torch.arange(size, dtype=torch.float).view(-1,1)*inv_freq
+
+    return torch.stack([angles.cos(), angles.sin()])
+
+def rotate(x, table, start=0):
+    """ Rotary positional encoding of x (..., T, dimension) at positions
+    start, start+1... (table: output of rotary_table) """
+    cos, sin = table[:, start:start+x.size(-2)].to(x.dtype)
+    x1, x2 = x[..., 0::2], x[..., 1::2]
+
+    return torch.stack([x1*cos - x2*sin, x1*sin + x2*cos], -1).flatten(-2)
+
 class MultiHeadAttention(Module):
     """ A MultiHeadAttention Module """
-    def __init__(self, N_heads, dk, dv, dmodel, device):
+    def __init__(self, N_heads, dk, dv, dmodel, device, rotary_size=None):
         """ Initializes the Multihead
 
         Args:
@@ -495,6 +786,10 @@ class MultiHeadAttention(Module):
             dk (int): The dimension of the space in which attention is computed.
             dv (int): The dimension of the space in which values are sent.
             dmodel (int): The model dimension.
+            rotary_size (int): If defined, the projected queries and keys are
+                rotated according to their position (self-attention only, T
+                <= rotary_size). Scores are computed over the concatenated
+                heads, so are the rotations.
         """
         super(MultiHeadAttention, self).__init__()
         self.dk = dk
@@ -503,8 +798,10 @@ class MultiHeadAttention(Module):
         self.Wk = Parameter(torch.empty(N_heads, dmodel, dk).to(device))
         self.Wv = Parameter(torch.empty(N_heads, dmodel, dv).to(device))
         self.Wo = Parameter(torch.empty(dmodel, dmodel).to(device))
+        self.register_buffer("rotary", None if rotary_size is None else
+                             rotary_table(rotary_size, N_heads*dk).to(device), persistent=False)
 
-    def forward(self, Q, K, V, maskout=False):
+    def forward(self, Q, K, V, mask=None):
         """ forward of a multihead attention
 
         Specially implemented to be computed in parallel by pytorch.
@@ -513,7 +810,10 @@ class MultiHeadAttention(Module):
             Q (torch.Tensor): The queries (B, T, dmodel)
             K (torch.Tensor): The keys (B, T, dmodel)
             V (torch.Tensor): The values (B, T, dmodel)
-            maskout (bool): Whether to apply or not forward masking.
+            mask (torch.Tensor): If defined, additive mask (-inf on the keys
+                a query must not attend to) added to the scores before the
+                softmax, broadcastable to (B, T, T): forward mask (T, T) or
+                key padding mask (B, 1, T).
 
         Returns:
             (B, T, dmodel) tensor
@@ -522,21 +822,224 @@ class MultiHeadAttention(Module):
         QWq_cat = torch.matmul(Q, torch.cat(self.Wq.unbind(), -1)) # (dmodel, N_heads*dk) --> (B, T, N_heads*dk)
         KWk_cat = torch.matmul(K, torch.cat(self.Wk.unbind(), -1)) # (B, T, N_heads*dk)
         VWv_cat = torch.matmul(V, torch.cat(self.Wv.unbind(), -1)) # (B, T, N_heads*dv)
+        if self.rotary is not None:
+            QWq_cat, KWk_cat = rotate(QWq_cat, self.rotary), rotate(KWk_cat, self.rotary)
 
         scores = torch.matmul(QWq_cat, KWk_cat.transpose(-2,-1)) /  math.sqrt(self.dk) # (B, T, T)
+        if mask is not None:
+            # same result as zeroing the masked softmax scores and
+            # renormalizing, in a single pass
+            scores = scores + mask
         scores = F.softmax(scores, dim=-1) # (B, T, T)
 
-        if maskout:
-            # set the upper triangular matrix to zero
-            mask_matrix = (torch.ones(scores.size()[1:]).tril(0)).unsqueeze(0).repeat(scores.size()[0], 1, 1).to(self.device)
-            scores = scores * mask_matrix
-            scores = scores/scores.sum(dim=-1,keepdim=True) # normalize
-            scores[scores != scores] = 0. # set NaN to zero
-
         att = torch.matmul(scores, VWv_cat) # (B, T, N_heads*dv=dmodel)
 
         return torch.matmul(att, self.Wo) # (B, T, Dmodel)
 
+    def project(self, X, W):
+        """ Projection of X by all the heads of W at once (B, T, N_heads*d) """
+        return torch.matmul(X, torch.cat(W.unbind(), -1))
+
+    def project_kv(self, K, V):
+        """ Projected keys and values, to be reused across decoding steps
+
+        Returns:
+            (B, T, N_heads*dk) and (B, T, N_heads*dv) tensors
+        """
+        return self.project(K, self.Wk), self.project(V, self.Wv)
+
+    def attend(self, QWq_cat, KWk_cat, VWv_cat, mask=None):
+        """ Attention of projected queries over projected keys/values
+        (B, T_q, dmodel), with an optional additive mask (see forward) """
+        scores = torch.matmul(QWq_cat, KWk_cat.transpose(-2,-1)) / math.sqrt(self.dk) # (B, T_q, T_k)
+        if mask is not None:
+            scores = scores + mask
+        scores = F.softmax(scores, dim=-1)
+
+        return torch.matmul(torch.matmul(scores, VWv_cat), self.Wo)
+
+    def attend_cached(self, Q, kv, mask=None):
+        """ Attention of the queries Q (B, T_q, dmodel) over keys/values
+        projected by project_kv """
+        return self.attend(self.project(Q, self.Wq), *kv, mask)
+
+    def init_cache(self, batch_size, max_len, dtype=torch.float):
+        """ Preallocated key/value buffers for incremental self-attention
+
+        Args:
+            batch_size (int)
+            max_len (int): Maximum number of positions.
+        """
+        return {"k": torch.empty(batch_size, max_len, self.Wk.size(0)*self.Wk.size(2),
+                                 dtype=dtype, device=self.Wk.device),
+                "v": torch.empty(batch_size, max_len, self.Wv.size(0)*self.Wv.size(2),
+                                 dtype=dtype, device=self.Wv.device),
+                "len": 0}
+
+    def forward_step(self, Q, K, V, cache):
+        """ Masked self-attention for the newest position only
+
+        The keys/values of the new position are written in the cache and the
+        query attends to all the cached positions. The forward masking is
+        implicit (there are no future positions in the cache): the result is
+        the same as the last position of forward with a forward mask.
+
+        Args:
+            Q (torch.Tensor): The queries (B, 1, dmodel)
+            K (torch.Tensor): The keys (B, 1, dmodel)
+            V (torch.Tensor): The values (B, 1, dmodel)
+            cache (dict): Output of init_cache, updated in place.
+
+        Returns:
+            (B, 1, dmodel) tensor
+        """
+        pos = cache["len"]
+        KWk_cat, VWv_cat = self.project_kv(K, V)
+        QWq_cat = self.project(Q, self.Wq)
+        if self.rotary is not None:
+            QWq_cat, KWk_cat = rotate(QWq_cat, self.rotary, pos), rotate(KWk_cat, self.rotary, pos)
+        cache["k"][:, pos:pos+1], cache["v"][:, pos:pos+1] = KWk_cat, VWv_cat
+        cache["len"] = pos+1
+
+        return self.attend(QWq_cat, cache["k"][:, :pos+1], cache["v"][:, :pos+1])
+
+class FusedMultiHeadAttention(Module):
+    """ Multi-head attention with per-head scores, as in the original paper
+
+    Unlike MultiHeadAttention (one score matrix over the concatenation of
+    the heads), each head has its own (T_q, T_k) attention. The projections
+    of all the heads for queries, keys and values are packed in a single
+    (dmodel, N_heads*(2*dk+dv)) weight: self-attention is projected with one
+    matmul, and the heads are a reshape to (B, N_heads, T, d).
+    """
+    def __init__(self, N_heads, dk, dv, dmodel, device, chunk_size=None, rotary_size=None):
+        """ Initializes the Multihead
+
+        Args:
+            N_heads (int): The number of attention heads.
+            dk (int): The dimension of the space in which attention is
+                computed, per head.
+            dv (int): The dimension of the space in which values are sent,
+                per head.
+            dmodel (int): The model dimension.
+            chunk_size (int): If defined, or if
+                F.scaled_dot_product_attention is not available, attention
+                is computed by chunks of chunk_size queries (memory
+                O(B*N_heads*chunk_size*T_k) instead of O(B*N_heads*T_q*T_k)).
+            rotary_size (int): If defined, the queries and keys of each head
+                are rotated according to their position (self-attention only,
+                T <= rotary_size).
+        """
+        super(FusedMultiHeadAttention, self).__init__()
+        self.N_heads = N_heads
+        self.dk = dk
+        self.dv = dv
+        self.device = device
+        self.chunk_size = chunk_size
+        self.Wqkv = Parameter(torch.empty(dmodel, N_heads*(2*dk+dv)).to(device))
+        self.Wo = Parameter(torch.empty(N_heads*dv, dmodel).to(device))
+        self.register_buffer("rotary", None if rotary_size is None else
+                             rotary_table(rotary_size, dk).to(device), persistent=False)
+
+    def split_heads(self, X, d):
+        """ (B, T, N_heads*d) -> (B, N_heads, T, d) """
+        return X.view(X.size(0), X.size(1), self.N_heads, d).transpose(1, 2)
+
+    def project_q(self, Q):
+        return self.split_heads(torch.matmul(Q, self.Wqkv[:, :self.N_heads*self.dk]), self.dk)
+
+    def project_kv(self, K, V):
+        """ Projected keys and values, (B, N_heads, T, dk) and (B, N_heads, T, dv) """
+        if K is V:
+            KV = torch.matmul(K, self.Wqkv[:, self.N_heads*self.dk:])
+            KWk, VWv = KV.split([self.N_heads*self.dk, self.N_heads*self.dv], -1)
+        else:
+            KWk = torch.matmul(K, self.Wqkv[:, self.N_heads*self.dk:2*self.N_heads*self.dk])
+            VWv = torch.matmul(V, self.Wqkv[:, 2*self.N_heads*self.dk:])
+
+        return self.split_heads(KWk, self.dk), self.split_heads(VWv, self.dv)
+
+    def forward(self, Q, K, V, mask=None):
+        """ forward of a multihead attention
+
+        Args:
+            Q (torch.Tensor): The queries (B, T, dmodel)
+            K (torch.Tensor): The keys (B, T, dmodel)
+            V (torch.Tensor): The values (B, T, dmodel)
+            mask (torch.Tensor): If defined, additive mask broadcastable to
+                (B, T, T), see MultiHeadAttention.forward.
+
+        Returns:
+            (B, T, dmodel) tensor
+        """
+        if Q is K and K is V: # self-attention: a single projection
+            QKV = torch.matmul(Q, self.Wqkv)
+            q, k, v = QKV.split([self.N_heads*self.dk, self.N_heads*self.dk, self.N_heads*self.dv], -1)
+            q, k, v = self.split_heads(q, self.dk), self.split_heads(k, self.dk), self.split_heads(v, self.dv)
+        else:
+            q = self.project_q(Q)
+            k, v = self.project_kv(K, V)
+        if self.rotary is not None:
+            q, k = rotate(q, self.rotary), rotate(k, self.rotary)
+
+        return self.merge(self.attention(q, k, v, mask))
+
+    def attention(self, q, k, v, mask=None):
+        """ Per-head attention (B, N_heads, T_q, dv) """
+        if mask is not None:
+            # same mask for all the heads
+            mask = mask.unsqueeze(-3) if mask.dim() == 3 else mask
+            mask = mask.to(q.dtype)
+
+        if self.chunk_size is None and hasattr(F, "scaled_dot_product_attention"):
+            return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+        chunk_size = self.chunk_size or 64
+        out = []
+        for start in range(0, q.size(2), chunk_size):
+            scores = torch.matmul(q[:, :, start:start+chunk_size], k.transpose(-2, -1)) / math.sqrt(self.dk)
+            if mask is not None:
+                scores = scores + (mask[..., start:start+chunk_size, :] if mask.size(-2) > 1 else mask)
+            out.append(torch.matmul(F.softmax(scores, dim=-1), v))
+
+        return torch.cat(out, 2)
+
+    def merge(self, att):
+        """ (B, N_heads, T, dv) -> (B, T, dmodel) """
+        att = att.transpose(1, 2).reshape(att.size(0), att.size(2), self.N_heads*self.dv)
+
+        return torch.matmul(att, self.Wo)
+
+    def attend_cached(self, Q, kv, mask=None):
+        """ Attention of the queries Q (B, T_q, dmodel) over keys/values
+        projected by project_kv """
+        return self.merge(self.attention(self.project_q(Q), *kv, mask))
+
+    def init_cache(self, batch_size, max_len, dtype=torch.float):
+        """ Preallocated key/value buffers for incremental self-attention """
+        return {"k": torch.empty(batch_size, self.N_heads, max_len, self.dk,
+                                 dtype=dtype, device=self.Wqkv.device),
+                "v": torch.empty(batch_size, self.N_heads, max_len, self.dv,
+                                 dtype=dtype, device=self.Wqkv.device),
+                "len": 0}
+
+    def forward_step(self, Q, K, V, cache):
+        """ Masked self-attention for the newest position only (see
+        MultiHeadAttention.forward_step)
+
+        Returns:
+            (B, 1, dmodel) tensor
+        """
+        pos = cache["len"]
+        k, v = self.project_kv(K, V)
+        q = self.project_q(Q)
+        if self.rotary is not None:
+            q, k = rotate(q, self.rotary, pos), rotate(k, self.rotary, pos)
+        cache["k"][:, :, pos:pos+1], cache["v"][:, :, pos:pos+1] = k, v
+        cache["len"] = pos+1
+
+        return self.merge(self.attention(q, cache["k"][:, :, :pos+1], cache["v"][:, :, :pos+1]))
+
 class FeedForward(Module):
     """ A FeedForward module """
     def __init__(self, inner_dim, dmodel, device):
@@ -571,20 +1074,11 @@ class Dataset(torch.utils.data.Dataset):
         source, target = self.pairs[idx] # one observation
         return torch.LongTensor(source), torch.LongTensor(target)
 
-def load_pairs(train_or_test):
-    with open("./data/" + 'pairs_' + train_or_test + '_ints.txt', 'r', encoding='utf-8') as file:
-        pairs_tmp = file.read().splitlines()
-
-    pairs_tmp = [elt.split('\t') for elt in pairs_tmp]
-    pairs_tmp = [[[int(eltt) for eltt in elt[0].split()],[int(eltt) for eltt in \
-                  elt[1].split()]] for elt in pairs_tmp]
-
-    return pairs_tmp
-
 if __name__ == "__main__":
 
-    pairs_train = load_pairs('train')
-    pairs_test = load_pairs('test')
+    # memory-mapped pair stores, built from pairs_*_ints.txt on the first run
+    pairs_train = load_pair_store("./data/", 'train')
+    pairs_test = load_pair_store("./data/", 'test')
 
     with open("./data/" + 'vocab_source.json','r') as file:
         vocab_source = json.load(file) # word -> index
@@ -621,8 +1115,7 @@ if __name__ == "__main__":
                'The kids were playing hide and seek',
                'The cat fell asleep in front of the fireplace'] 
 
-    #test_loader = DataLoader(Dataset(pairs_test), batch_size=16, 
-    #                      shuffle=False, collate_fn=model.my_pad)
+    #test_loader = model.sorted_loader(pairs_test, batch_size=16)
 
     #model.test(test_loader)
 
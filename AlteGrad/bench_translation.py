@@ -0,0 +1,291 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import subprocess
+import numpy as np
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+# benchmark of the TP4 (seq2seq + attention) and TP7 (transformer) translation models:
+# - training steps: sentences/sec and tokens/sec
+# - decoding (what predict does, after tokenization): p50/p95/p99 latency per batch, for batch sizes 1..256
+#   and several source lengths
+# results are written as JSON (with the commit and environment), to compare runs across commits
+#
+# usage: python bench_translation.py [--tp4 path_to_model.pt|synthetic] [--tp7 path_to_model.pt|synthetic] [--out results.json]
+# models are loaded with .load(), untrained models on synthetic vocabularies are used when the files are absent
+
+path_root = os.path.dirname(os.path.abspath(__file__))
+# TP4/code comes first on the path: sampler.py and pair_store.py are imported from TP4/code (TP7/code holds
+# identical copies, see the header of these files)
+sys.path.insert(0, os.path.join(path_root,'TP7','code'))
+sys.path.insert(0, os.path.join(path_root,'TP4','code'))
+
+from model import seq2seqModel
+from transformer_moodle import Transformer
+from pair_store import PadCollate, load_pair_store
+
+# = = = = = models = = = = =
+
+def synthetic_vocabularies(n_words_s, n_words_t):
+    '''source vocabulary (word -> index) and inverse target vocabulary (index -> word), indexes 0 to 3 being
+    <pad>, <oov>, <sos> and <eos>'''
+    vocab_s = {'s'+str(idx):idx for idx in range(4,n_words_s+4)}
+    vocab_t_inv = {idx:'t'+str(idx) for idx in range(4,n_words_t+4)}
+    return vocab_s, vocab_t_inv
+
+
+def load_tp4(path_to_model, n_words=5000):
+    '''TP4 model saved by seq2seqModel.save, or an untrained model with the sizes used in TP4/code/main.py'''
+    if os.path.exists(path_to_model):
+        return seq2seqModel.load(path_to_model), False
+    vocab_s, vocab_t_inv = synthetic_vocabularies(n_words,n_words)
+    model = seq2seqModel(vocab_s=vocab_s,source_language='english',vocab_t_inv=vocab_t_inv,
+                         embedding_dim_s=40,embedding_dim_t=40,hidden_dim_s=30,hidden_dim_t=30,hidden_dim_att=20,
+                         do_att=True,padding_token=0,oov_token=1,sos_token=2,eos_token=3,max_size=30)
+    return model, True
+
+
+def load_tp7(path_to_model, device, n_words=5000):
+    '''TP7 model saved by Transformer.save, or an untrained model with the sizes used in transformer_moodle.py'''
+    if os.path.exists(path_to_model):
+        return Transformer.load(path_to_model,device=device), False
+    vocab_s, vocab_t_inv = synthetic_vocabularies(n_words,n_words)
+    model = Transformer(N_stacks_encoder=3,N_stacks_decoder=3,N_heads=8,dk=16,dv=16,dmodel=128,ff_inner_dim=512,
+                        vocab_source=vocab_s,vocab_target_inv=vocab_t_inv,max_size=24,device=device)
+    return model, True
+
+
+class TP4Bench(object):
+    '''training step and batched decoding of a seq2seqModel'''
+    def __init__(self, model, teacher_forcing=False):
+        self.model = model
+        self.teacher_forcing = teacher_forcing
+        self.device = model.device
+        self.max_source_idx = model.max_source_idx
+        self.max_target_idx = model.max_target_idx
+        self.max_size = model.max_size
+        self.collate = PadCollate(model.eos_token,model.padding_token)
+        self.optimizer = torch.optim.Adam(model.parameters(),lr=1e-3)
+        self.criterion = torch.nn.CrossEntropyLoss(ignore_index=model.padding_token)
+
+    def train_step(self, pairs):
+        '''one optimization step on a batch of (source,target) pairs, returns the number of real tokens'''
+        self.model.train()
+        batch_source, batch_target, source_lengths = self.collate(pairs)
+        batch_source = batch_source.t().to(self.device)
+        batch_target = batch_target.t().to(self.device)
+        if self.teacher_forcing:
+            logits = self.model.forward_teacher_forcing(batch_source,batch_target,source_lengths)
+        else:
+            logits = self.model.forward(batch_source,batch_target.size(0),False,source_lengths)
+        loss = self.criterion(logits.flatten(end_dim=1),batch_target.flatten())
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        return int(source_lengths.sum()) + int((batch_target!=self.model.padding_token).sum())
+
+    def decode(self, sources):
+        '''greedy decoding of a list of source tensors, as predict_many'''
+        self.model.eval()
+        batch_source = pad_sequence(sources,padding_value=self.model.padding_token).to(self.device) # (seq,batch)
+        source_lengths = torch.LongTensor([len(elt) for elt in sources])
+        target_ints, _ = self.model.decode_greedy(batch_source,self.max_size,source_lengths=source_lengths)
+        return target_ints.cpu()
+
+
+class TP7Bench(object):
+    '''training step and batched decoding of a Transformer'''
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        self.max_source_idx = len(model.vocab_source)+3
+        self.max_target_idx = model.vocab_size_target-1
+        self.max_size = model.max_size
+        self.optimizer = torch.optim.Adam(model.parameters(),lr=1e-4,betas=(0.9,0.98),eps=1e-09)
+        self.criterion = torch.nn.CrossEntropyLoss()
+
+    def train_step(self, pairs):
+        self.model.train()
+        source, target = self.model.my_pad(pairs)
+        source = source.to(self.device)
+        target = target.to(self.device)
+        pred = self.model.forward(source,target)
+        mask = target.flatten() != self.model.PAD_token
+        loss = self.criterion(pred.flatten(end_dim=1)[mask,:],target.flatten()[mask])
+        self.optimizer.zero_grad()
+        loss.backward()
+        self.optimizer.step()
+        return int((source!=self.model.PAD_token).sum()) + int(mask.sum())
+
+    def decode(self, sources):
+        '''greedy decoding of a list of source tensors, as predict'''
+        self.model.eval()
+        batch_source = pad_sequence(sources,batch_first=True,padding_value=self.model.PAD_token)[:,:self.max_size-1]
+        return self.model.forward(batch_source.to(self.device)).argmax(-1).cpu()
+
+# = = = = = data = = = = =
+
+class PairSampler(object):
+    '''(source,target) pairs of a given source length, drawn from a pair store if one is given
+    (pairs whose source length is the closest to the requested one), random integers otherwise'''
+    def __init__(self, max_source_idx, max_target_idx, store=None, seed=0):
+        self.max_source_idx = max_source_idx
+        self.max_target_idx = max_target_idx
+        self.store = store
+        self.rng = np.random.RandomState(seed)
+        if store is not None:
+            self.source_lengths = store.lengths()[0]
+
+    def sample(self, n_pairs, length):
+        if self.store is not None:
+            gaps = np.abs(self.source_lengths-length)
+            candidates = np.where(gaps==gaps.min())[0]
+            return [tuple(elt.long() for elt in self.store[idx]) for idx in self.rng.choice(candidates,n_pairs)]
+        pairs = []
+        for _ in range(n_pairs):
+            target_length = max(1,int(round(length*self.rng.uniform(0.8,1.2))))
+            pairs.append((torch.from_numpy(self.rng.randint(4,self.max_source_idx+1,length,dtype=np.int64)),
+                          torch.from_numpy(self.rng.randint(4,self.max_target_idx+1,target_length,dtype=np.int64))))
+        return pairs
+
+# = = = = = measurements = = = = =
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb(device):
+    '''peak CUDA memory allocated since the last reset, or, on CPU, the peak resident memory of the process
+    (ru_maxrss, which cannot be reset: it is the max over all the measurements made so far)'''
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated()/2**20
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss/2**20 if sys.platform == 'darwin' else maxrss/2**10 # bytes on macOS, KB on Linux
+
+
+def bench_training(bench, sampler, batch_sizes, lengths, n_steps):
+    '''sentences/sec and tokens/sec (real tokens, <eos> included) of training steps'''
+    results = []
+    for batch_size in batch_sizes:
+        for length in lengths:
+            batches = [sampler.sample(batch_size,length) for _ in range(n_steps+1)]
+            bench.train_step(batches[0]) # warm up
+            reset_peak_memory(bench.device)
+            synchronize(bench.device)
+            n_tokens = 0
+            t0 = time.time()
+            for batch in batches[1:]:
+                n_tokens += bench.train_step(batch)
+            synchronize(bench.device)
+            duration = time.time()-t0
+            results.append({'batch_size':batch_size, 'length':length,
+                            'sentences_per_sec':n_steps*batch_size/duration, 'tokens_per_sec':n_tokens/duration,
+                            'step_ms':1000*duration/n_steps, 'peak_memory_mb':peak_memory_mb(bench.device)})
+            print('train  batch size %3i, length %2i: %8.1f sentences/sec, %9.1f tokens/sec' %
+                  (batch_size,length,results[-1]['sentences_per_sec'],results[-1]['tokens_per_sec']))
+    return results
+
+
+def bench_decoding(bench, sampler, batch_sizes, lengths, n_runs):
+    '''latency percentiles (ms) of batched greedy decoding, and the corresponding sentences/sec'''
+    results = []
+    with torch.no_grad():
+        for batch_size in batch_sizes:
+            for length in lengths:
+                batches = [[source for source,_ in sampler.sample(batch_size,length)] for _ in range(n_runs+1)]
+                bench.decode(batches[0]) # warm up
+                reset_peak_memory(bench.device)
+                times = []
+                n_tokens = 0
+                for batch in batches[1:]:
+                    synchronize(bench.device)
+                    t0 = time.time()
+                    n_tokens += bench.decode(batch).numel()
+                    times.append(1000*(time.time()-t0)) # decode returns on the host: no need to synchronize again
+                times = np.array(times)
+                results.append({'batch_size':batch_size, 'length':length,
+                                'p50_ms':float(np.percentile(times,50)), 'p95_ms':float(np.percentile(times,95)),
+                                'p99_ms':float(np.percentile(times,99)), 'mean_ms':float(times.mean()),
+                                'sentences_per_sec':1000*batch_size/float(times.mean()),
+                                'tokens_per_sec':1000*n_tokens/float(times.sum()), # generated tokens (padded batch)
+                                'peak_memory_mb':peak_memory_mb(bench.device)})
+                print('decode batch size %3i, length %2i: p50 %8.2f ms, p95 %8.2f ms, p99 %8.2f ms, %8.1f sentences/sec' %
+                      (batch_size,length,results[-1]['p50_ms'],results[-1]['p95_ms'],results[-1]['p99_ms'],
+                       results[-1]['sentences_per_sec']))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=path_root,stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(string):
+    return [int(elt) for elt in string.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='training throughput and decoding latency of the TP4 and TP7 models')
+    parser.add_argument('--tp4', default=os.path.join(path_root,'TP4','models','pretrained_moodle.pt'),
+                        help='TP4 model (synthetic if the file does not exist, "none" to skip)')
+    parser.add_argument('--tp7', default=os.path.join(path_root,'TP7','code','trained_transformer.pt'),
+                        help='TP7 model (synthetic if the file does not exist, "none" to skip)')
+    parser.add_argument('--tp4_data', default=os.path.join(path_root,'TP4','data')+os.sep,
+                        help='directory of pairs_test_ints.txt, used (with a real model) to sample real sentences')
+    parser.add_argument('--tp7_data', default=os.path.join(path_root,'TP7','code','data')+os.sep)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device of the TP7 model (the TP4 model picks cuda when available)')
+    parser.add_argument('--batch_sizes', type=int_list, default=[1,2,4,8,16,32,64,128,256])
+    parser.add_argument('--lengths', type=int_list, default=[5,10,20], help='source sentence lengths')
+    parser.add_argument('--train_batch_sizes', type=int_list, default=[32,64,128])
+    parser.add_argument('--n_runs', type=int, default=20, help='decoding calls per (batch size,length)')
+    parser.add_argument('--n_steps', type=int, default=10, help='training steps per (batch size,length)')
+    parser.add_argument('--teacher_forcing', action='store_true', help='TP4 training steps with teacher forcing')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench_translation.json')
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    results = {'meta':{'commit':git_commit(), 'time':time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'torch':torch.__version__, 'python':platform.python_version(), 'machine':platform.machine(),
+                       'device':args.device, 'n_threads':torch.get_num_threads(), 'args':vars(args)}}
+
+    for name in ['TP4','TP7']:
+        path_to_model = getattr(args,name.lower())
+        if path_to_model == 'none':
+            continue
+        if name == 'TP4':
+            model, synthetic = load_tp4(path_to_model)
+            bench = TP4Bench(model,args.teacher_forcing)
+        else:
+            model, synthetic = load_tp7(path_to_model,args.device)
+            bench = TP7Bench(model)
+        path_to_data = getattr(args,name.lower()+'_data')
+        use_data = not synthetic and os.path.exists(path_to_data+'pairs_test_ints.txt')
+        store = load_pair_store(path_to_data,'test') if use_data else None
+        sampler = PairSampler(bench.max_source_idx,bench.max_target_idx,store,args.seed)
+
+        print('= = = %s (%s model, %s sentences) = = =' % (name,'synthetic' if synthetic else 'trained',
+                                                            'real' if use_data else 'random'))
+        results[name] = {'synthetic_model':synthetic, 'real_sentences':use_data,
+                         'n_parameters':sum(p.numel() for p in model.parameters()),
+                         'train':bench_training(bench,sampler,args.train_batch_sizes,args.lengths,args.n_steps),
+                         'decode':bench_decoding(bench,sampler,args.batch_sizes,args.lengths,args.n_runs)}
+
+    with open(args.out,'w') as file:
+        json.dump(results,file,indent=2)
+    print('results written to',args.out)